@@ -11,6 +11,8 @@ const AttendanceMode = () => {
     const navigate = useNavigate();
     const videoRef = useRef(null);
     const canvasRef = useRef(null);
+    // Lets the recognition API track faces across this kiosk's frames
+    const kioskIdRef = useRef(`kiosk-${Date.now()}-${Math.random().toString(36).slice(2)}`);
 
     // State
     const [className, setClassName] = useState('');
@@ -113,16 +115,32 @@ const AttendanceMode = () => {
             const ctx = canvas.getContext('2d');
             ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
 
-            // Get Base64
-            const imageBase64 = canvas.toDataURL('image/jpeg');
+            // Get raw JPEG bytes (no base64: ~33% smaller upload)
+            const imageBlob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.9));
 
             // Send to Python API
-            const response = await axios.post('http://localhost:5006/recognize', { image: imageBase64 });
-            const recognized = response.data; // [{ usn: '...', confidence: ... }]
+            // Scope matching to this class's students, and let the API record attendance
+            // for them when its write-behind mode is on
+            const response = await axios.post('http://localhost:5006/recognize', imageBlob, {
+                params: {
+                    class_id: classId,
+                    mark: 1,
+                    subject_id: currentSlot?.subject_id,
+                    timetable_id: currentSlot?.id,
+                    method: isAutoMode ? 'auto' : 'manual'
+                },
+                headers: { 'Content-Type': 'image/jpeg', 'X-Kiosk-Id': kioskIdRef.current }
+            });
+            const recognized = response.data; // [{ usn: '...', confidence: ..., attendance?: 'marked' | ... }]
 
             if (recognized.length > 0) {
                 for (const rec of recognized) {
-                    await handleAttendance(rec.usn);
+                    // 'unverified': the API couldn't check this slot against the DB, so mark it here
+                    if (rec.attendance && rec.attendance !== 'unverified') {
+                        handleServerAttendance(rec);
+                    } else {
+                        await handleAttendance(rec.usn);
+                    }
                 }
             }
 
@@ -133,6 +151,43 @@ const AttendanceMode = () => {
         }
     };
 
+    // The API already recorded (or deduplicated) this student: only update the UI
+    const handleServerAttendance = (rec) => {
+        const student = studentsMap.get(rec.usn);
+        const name = student?.full_name || rec.usn;
+
+        if (rec.attendance === 'unknown_student') {
+            const lastWarn = lastRecognized.get(`WARN_${rec.usn}`);
+            if (!lastWarn || Date.now() - lastWarn > 5000) {
+                toast.warn(`Unknown Student: ${rec.usn} (Not found in DB)`);
+                setLastRecognized(prev => new Map(prev).set(`WARN_${rec.usn}`, Date.now()));
+            }
+            return;
+        }
+
+        // Same cooldown as local marking, so "already marked" doesn't toast every frame
+        const lastTime = lastRecognized.get(rec.usn);
+        if (lastTime && (Date.now() - lastTime < 300000)) {
+            return;
+        }
+        setLastRecognized(prev => new Map(prev).set(rec.usn, Date.now()));
+
+        if (rec.attendance === 'already_marked') {
+            toast.warning(`${name} already marked.`);
+            return;
+        }
+
+        toast.success(`Marked Present: ${name}`);
+        const newLog = {
+            id: Date.now(),
+            name,
+            usn: rec.usn,
+            time: new Date().toLocaleTimeString(),
+            avatar: student?.avatar_url
+        };
+        setLogs(prev => [newLog, ...prev].slice(0, 10)); // Keep last 10
+    };
+
     const handleAttendance = async (usn) => {
         // Warning: USN from Python might be slightly different if case mismatch or hidden chars
         // But we rely on exact string match for now.
@@ -0,0 +1,280 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+import metrics
+
+# Recognition results reported back to the kiosk
+MARKED = "marked"
+ALREADY_MARKED = "already_marked"
+UNKNOWN_STUDENT = "unknown_student"
+# The slot's existing rows couldn't be loaded, so nothing was queued; the kiosk marks it itself
+UNVERIFIED = "unverified"
+
+
+class SupabaseBackend:
+    """Attendance storage in the Supabase attendance/profiles tables."""
+
+    def __init__(self, client, table="attendance"):
+        # One client for all writes; its HTTP session keeps connections open between flushes
+        self.client = client
+        self.table = table
+
+    def student_ids(self, usns):
+        response = self.client.table("profiles").select("id, usn").eq("role", "student").in_("usn", list(usns)).execute()
+        return {row["usn"]: row["id"] for row in response.data}
+
+    def marked(self, slot):
+        """student_ids already marked for the slot, matched like the kiosk does (no subject matches any row that day)."""
+        class_id, date, subject_id = slot
+        query = self.client.table(self.table).select("student_id").eq("class_id", class_id).eq("date", date)
+        if subject_id:
+            query = query.eq("subject_id", subject_id)
+        return {row["student_id"] for row in query.execute().data}
+
+    def insert(self, rows):
+        # Rows carry their own id, so a retried batch that already landed is skipped, not duplicated
+        self.client.table(self.table).upsert(rows, on_conflict="id", ignore_duplicates=True).execute()
+
+
+class MemoryBackend:
+    """Stand-in for Supabase: students {usn: id}, rows kept in a list. fail_inserts > 0 simulates an outage."""
+
+    def __init__(self, students=None):
+        self.students = dict(students or {})
+        self.rows = []
+        self.fail_inserts = 0
+        self.queries = 0
+
+    def student_ids(self, usns):
+        self.queries += 1
+        return {usn: self.students[usn] for usn in usns if usn in self.students}
+
+    def marked(self, slot):
+        self.queries += 1
+        class_id, date, subject_id = slot
+        return {row["student_id"] for row in self.rows
+                if row["class_id"] == class_id and row["date"] == date
+                and (not subject_id or row["subject_id"] == subject_id)}
+
+    def insert(self, rows):
+        self.queries += 1
+        if self.fail_inserts > 0:
+            self.fail_inserts -= 1
+            raise ConnectionError("simulated outage")
+        known = {row["id"] for row in self.rows}
+        self.rows.extend(row for row in rows if row["id"] not in known)
+
+
+class AttendanceWriter:
+    """
+    Turns recognitions into attendance rows without a database round trip per face.
+
+    Each slot (class, date, subject; the same key the kiosk deduplicates on) is
+    checked against the database once, the first time it is marked; after that
+    duplicates are caught by an in-memory set. Until a slot has been loaded,
+    nothing is queued for it and marks come back UNVERIFIED. New rows are queued and written in batches by a
+    background thread, retried with exponential backoff while the backend is
+    down. Every queued row is first appended to a local journal (JSON lines),
+    and written rows are acknowledged there, so rows still pending when the
+    process stops are replayed on the next start.
+    """
+
+    def __init__(self, backend, journal_path, batch_size=200, flush_interval=2.0,
+                 max_backoff=60.0, id_ttl=300.0):
+        self.backend = backend
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.id_ttl = id_ttl
+        self._lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._queue = deque()
+        self._seen = {}  # slot -> student_ids marked (in the database or queued)
+        self._warmed = set()  # slots whose existing rows were loaded
+        self._ids = {}  # usn -> (student_id or None, fetched_at)
+        self._date = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._replay()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True, name="attendance-writer")
+        self._thread.start()
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    # --- marking ---
+
+    def mark(self, usns, class_id, subject_id=None, timetable_id=None, method="auto", status="present"):
+        """
+        Queues attendance for the recognized USNs.
+        Returns {usn: MARKED / ALREADY_MARKED / UNKNOWN_STUDENT / UNVERIFIED}.
+        """
+        date = datetime.now(timezone.utc).date().isoformat()
+        slot = (class_id, date, subject_id or None)
+        ids = self._student_ids(usns)
+        if date != self._date:
+            # New day: yesterday's slots can't be marked again
+            with self._lock:
+                self._seen = {key: value for key, value in self._seen.items() if key[1] >= date}
+                self._warmed = {key for key in self._warmed if key[1] >= date}
+                self._date = date
+        warmed = self._warm(slot)
+
+        results = {}
+        rows = []
+        with self._lock:
+            seen = self._seen.setdefault(slot, set())
+            for usn in dict.fromkeys(usns):
+                student_id = ids.get(usn)
+                if student_id is None:
+                    results[usn] = UNKNOWN_STUDENT
+                elif student_id in seen:
+                    results[usn] = ALREADY_MARKED
+                elif not warmed:
+                    # Without the database's view of the slot a new row could be a duplicate
+                    results[usn] = UNVERIFIED
+                else:
+                    seen.add(student_id)
+                    results[usn] = MARKED
+                    rows.append({
+                        "id": str(uuid.uuid4()),
+                        "student_id": student_id,
+                        "class_id": class_id,
+                        "subject_id": slot[2],
+                        "timetable_id": timetable_id or None,
+                        "date": date,
+                        "timestamp": datetime.now(timezone.utc).isoformat(),
+                        "status": status,
+                        "method": method,
+                    })
+        if rows:
+            # Journal first: once mark() returns, the rows survive a crash
+            with self._journal_lock:
+                self._write_journal([{"row": row} for row in rows])
+                with self._lock:
+                    self._queue.extend(rows)
+            if len(self._queue) >= self.batch_size:
+                self._wake.set()
+        for result in results.values():
+            metrics.ATTENDANCE.inc(result=result)
+        return results
+
+    def _student_ids(self, usns):
+        """{usn: student_id} from profiles, cached for id_ttl seconds (unknown USNs too)."""
+        now = time.time()
+        with self._lock:
+            missing = [usn for usn in set(usns)
+                       if usn not in self._ids or now - self._ids[usn][1] >= self.id_ttl]
+        if missing:
+            with metrics.stage("attendance_lookup"):
+                found = self.backend.student_ids(missing)
+            with self._lock:
+                for usn in missing:
+                    self._ids[usn] = (found.get(usn), now)
+        with self._lock:
+            return {usn: self._ids[usn][0] for usn in usns}
+
+    def _warm(self, slot):
+        """Loads the rows a slot already has, once. Returns False on failure (retried on the next mark)."""
+        if slot in self._warmed:
+            return True
+        try:
+            with metrics.stage("attendance_warm"):
+                existing = self.backend.marked(slot)
+        except Exception as e:
+            print(f"Attendance: could not load existing rows for {slot}: {e}")
+            return False
+        with self._lock:
+            self._seen.setdefault(slot, set()).update(existing)
+            self._warmed.add(slot)
+        return True
+
+    # --- writing ---
+
+    def _flush_loop(self):
+        backoff = self.flush_interval
+        while not self._stopped.is_set():
+            self._wake.wait(backoff)
+            self._wake.clear()
+            backoff = self.flush_interval if self.flush() else min(backoff * 2, self.max_backoff)
+
+    def flush(self):
+        """Writes everything queued, in batches. Returns False if the backend failed."""
+        while True:
+            with self._lock:
+                batch = [self._queue[i] for i in range(min(self.batch_size, len(self._queue)))]
+            if not batch:
+                return True
+            try:
+                with metrics.stage("attendance_flush"):
+                    self.backend.insert(batch)
+            except Exception as e:
+                print(f"Attendance: write of {len(batch)} rows failed, will retry: {e}")
+                metrics.ATTENDANCE_WRITES.inc(len(batch), result="retried")
+                return False
+            with self._lock:
+                for _ in batch:
+                    self._queue.popleft()
+                drained = not self._queue
+            with self._journal_lock:
+                self._write_journal([{"ack": [row["id"] for row in batch]}])
+            metrics.ATTENDANCE_WRITES.inc(len(batch), result="written")
+            if drained:
+                self._compact_journal()
+
+    def close(self, timeout=10.0):
+        """Stops the writer after a last flush; whatever is still pending stays in the journal."""
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self.flush()
+
+    # --- journal ---
+
+    def _write_journal(self, entries):
+        # Caller holds _journal_lock
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact_journal(self):
+        """Everything was written; start an empty journal (unless rows were queued meanwhile)."""
+        with self._journal_lock, self._lock:
+            if self._queue:
+                return
+            directory = os.path.dirname(self.journal_path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".attendance-", suffix=".tmp")
+            os.close(fd)
+            os.replace(tmp_path, self.journal_path)
+
+    def _replay(self):
+        """Re-queues journaled rows that were never acknowledged."""
+        if not os.path.exists(self.journal_path):
+            return
+        rows = {}
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash mid-write
+                if "row" in entry:
+                    rows[entry["row"]["id"]] = entry["row"]
+                for row_id in entry.get("ack", []):
+                    rows.pop(row_id, None)
+        for row in rows.values():
+            self._queue.append(row)
+            slot = (row["class_id"], row["date"], row["subject_id"])
+            self._seen.setdefault(slot, set()).add(row["student_id"])
+        if rows:
+            print(f"Attendance: replaying {len(rows)} unwritten rows from {self.journal_path}")
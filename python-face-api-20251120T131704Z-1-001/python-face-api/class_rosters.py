@@ -0,0 +1,91 @@
+import threading
+import time
+
+
+class RosterCache:
+    """
+    Class rosters and the per-class partitions of the embedding index built from them.
+
+    A roster is the set of USNs in a class. It is either pushed by a client
+    (kept until replaced) or fetched on demand with fetch_roster(class_id) and
+    kept for ttl seconds. Each class gets its own small EmbeddingIndex view, so a
+    scoped /recognize searches ~60 students instead of the whole college. Views
+    are rebuilt lazily whenever the main index has changed since they were cut.
+
+    A failed fetch is remembered for failure_ttl seconds, so an outage costs one
+    query per class rather than one per request; meanwhile an expired roster
+    is still served if there is one.
+    """
+
+    def __init__(self, index, fetch_roster, ttl=300.0, failure_ttl=30.0):
+        self.index = index
+        self.fetch_roster = fetch_roster
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self._rosters = {}  # class_id -> (usns, fetched_at or None if pushed)
+        self._failures = {}  # class_id -> (error, failed_at)
+        self._views = {}  # class_id -> (index version, view)
+        self._lock = threading.Lock()
+
+    def push(self, class_id, usns):
+        with self._lock:
+            self._rosters[class_id] = (frozenset(usns), None)
+            self._views.pop(class_id, None)
+
+    def forget(self, class_id):
+        with self._lock:
+            self._rosters.pop(class_id, None)
+            self._views.pop(class_id, None)
+
+    def roster(self, class_id):
+        with self._lock:
+            cached = self._rosters.get(class_id)
+        if cached is not None:
+            usns, fetched_at = cached
+            if fetched_at is None or time.time() - fetched_at < self.ttl:
+                return usns
+        with self._lock:
+            failure = self._failures.get(class_id)
+        if failure is not None and time.time() - failure[1] < self.failure_ttl:
+            if cached is not None:
+                return cached[0]
+            raise RuntimeError(f"roster fetch failed {time.time() - failure[1]:.0f}s ago: {failure[0]}")
+        try:
+            usns = frozenset(self.fetch_roster(class_id))
+        except Exception as e:
+            with self._lock:
+                self._failures[class_id] = (e, time.time())
+            if cached is not None:
+                print(f"Roster for class {class_id} could not be refreshed, keeping the old one: {e}")
+                return cached[0]
+            raise
+        if not usns:
+            print(f"Roster for class {class_id} is empty: no student profile has this class_id")
+        with self._lock:
+            self._failures.pop(class_id, None)
+            # A roster pushed while we were fetching wins
+            current = self._rosters.get(class_id)
+            if current is None or current[1] is not None:
+                self._rosters[class_id] = (usns, time.time())
+                if current is None or current[0] != usns:
+                    self._views.pop(class_id, None)
+            else:
+                usns = current[0]
+        return usns
+
+    def view(self, class_id):
+        """The index partition for one class."""
+        usns = self.roster(class_id)
+        version = self.index.version
+        with self._lock:
+            cached = self._views.get(class_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        view = self.index.subset(usns)
+        with self._lock:
+            self._views[class_id] = (version, view)
+        return view
+
+    def sizes(self):
+        with self._lock:
+            return {class_id: len(usns) for class_id, (usns, _) in self._rosters.items()}
@@ -0,0 +1,227 @@
+import threading
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+class EmbeddingIndex:
+    """
+    Resident per-student face templates.
+    Every student keeps all of their enrollment embeddings (samples) plus a
+    precomputed, L2-normalized centroid and an adaptive match threshold.
+    A lookup compares queries against the centroid matrix only, O(students);
+    the individual samples are consulted just for ambiguous results.
+
+    Layout: samples are stored grouped by student, student i owning rows
+    offsets[i]:offsets[i + 1], so everything lives in a few contiguous float32
+    arrays. Readers never take the lock: every mutation builds new arrays and
+    swaps them in, so a search always sees a complete snapshot.
+    """
+
+    def __init__(self, threshold=None, ann_threshold=None, ambiguity_margin=0.05, min_threshold_ratio=0.75):
+        self._lock = threading.Lock()
+        # Global cosine distance cut-off; per-student thresholds never exceed it
+        self.threshold = threshold
+        # Switch centroid search to an HNSW index above this many students (None = always exact)
+        self.ann_threshold = ann_threshold
+        # Results closer than this to each other (or to the threshold) are re-checked against samples
+        self.ambiguity_margin = ambiguity_margin
+        # How far below the global threshold a very consistent student's threshold may go
+        self.min_threshold_ratio = min_threshold_ratio
+        self.version = 0
+        self._set_snapshot(self._empty_snapshot(0))
+
+    @staticmethod
+    def _empty_snapshot(dim):
+        return {
+            "labels": np.array([], dtype=object),
+            "centroids": np.zeros((0, dim), dtype=np.float32),
+            "thresholds": np.zeros(0, dtype=np.float32),
+            "samples": np.zeros((0, dim), dtype=np.float32),
+            "offsets": np.zeros(1, dtype=np.int64),
+            "ann": None,
+        }
+
+    def _set_snapshot(self, snapshot):
+        # Single assignment so readers never mix arrays from two versions
+        self._snapshot = snapshot
+        self.version += 1
+
+    def __len__(self):
+        return len(self._snapshot["labels"])
+
+    def __contains__(self, usn):
+        return bool((self._snapshot["labels"] == usn).any())
+
+    @property
+    def sample_count(self):
+        return len(self._snapshot["samples"])
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(vectors / norms, dtype=np.float32)
+
+    def _template(self, samples):
+        """Centroid and adaptive threshold for one student's normalized samples."""
+        centroid = self._normalize(samples.mean(axis=0))[0]
+        if self.threshold is None:
+            return centroid, np.inf
+        if len(samples) < 3:
+            # Too few photos to estimate spread; use the global cut-off
+            return centroid, self.threshold
+        spread = 1.0 - samples @ centroid
+        adaptive = float(spread.mean() + 3 * spread.std())
+        return centroid, float(np.clip(adaptive, self.threshold * self.min_threshold_ratio, self.threshold))
+
+    def replace_many(self, entries):
+        """Sets the embeddings for several USNs in one swap. entries: {usn: [vector, ...]}"""
+        with self._lock:
+            current = self._snapshot
+            keep = ~np.isin(current["labels"], list(entries.keys()))
+            counts = np.diff(current["offsets"])
+
+            labels = [current["labels"][keep]]
+            centroids = [current["centroids"][keep]]
+            thresholds = [current["thresholds"][keep]]
+            samples = [current["samples"][np.repeat(keep, counts)]]
+            new_counts = [counts[keep]]
+
+            for usn, embeddings in entries.items():
+                if embeddings is None or len(embeddings) == 0:
+                    continue
+                vectors = self._normalize(embeddings)
+                if centroids[0].shape[1] != vectors.shape[1] and len(centroids[0]) == 0:
+                    # Empty so far: adopt the model's embedding width
+                    centroids[0] = centroids[0].reshape(0, vectors.shape[1])
+                    samples[0] = samples[0].reshape(0, vectors.shape[1])
+                centroid, threshold = self._template(vectors)
+                labels.append(np.array([usn], dtype=object))
+                centroids.append(centroid[np.newaxis, :])
+                thresholds.append(np.array([threshold], dtype=np.float32))
+                samples.append(vectors)
+                new_counts.append(np.array([len(vectors)]))
+
+            self._swap(np.concatenate(labels), np.concatenate(centroids), np.concatenate(thresholds),
+                       np.concatenate(samples), np.concatenate(new_counts))
+
+    def remove(self, usns):
+        """Drops every embedding belonging to the given USNs."""
+        with self._lock:
+            current = self._snapshot
+            keep = ~np.isin(current["labels"], list(usns))
+            counts = np.diff(current["offsets"])
+            self._swap(current["labels"][keep], current["centroids"][keep], current["thresholds"][keep],
+                       current["samples"][np.repeat(keep, counts)], counts[keep])
+
+    def subset(self, usns):
+        """
+        A standalone index holding only the given USNs (e.g. one class roster).
+        It is a copy of the current snapshot and does not follow later updates;
+        compare version to know when to rebuild it.
+        """
+        snapshot = self._snapshot
+        keep = np.isin(snapshot["labels"], list(usns))
+        counts = np.diff(snapshot["offsets"])
+        view = EmbeddingIndex(threshold=self.threshold, ann_threshold=self.ann_threshold,
+                              ambiguity_margin=self.ambiguity_margin, min_threshold_ratio=self.min_threshold_ratio)
+        view._swap(snapshot["labels"][keep], snapshot["centroids"][keep], snapshot["thresholds"][keep],
+                   snapshot["samples"][np.repeat(keep, counts)], counts[keep])
+        return view
+
+    def clear(self):
+        with self._lock:
+            self._set_snapshot(self._empty_snapshot(self._snapshot["centroids"].shape[1]))
+
+    def _swap(self, labels, centroids, thresholds, samples, counts):
+        centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        ann = None
+        if self.ann_threshold is not None and hnswlib is not None and len(labels) >= self.ann_threshold:
+            ann = hnswlib.Index(space="cosine", dim=centroids.shape[1])
+            ann.init_index(max_elements=len(labels), ef_construction=200, M=16)
+            ann.add_items(centroids, np.arange(len(labels)))
+            ann.set_ef(64)
+        self._set_snapshot({
+            "labels": labels,
+            "centroids": centroids,
+            "thresholds": np.asarray(thresholds, dtype=np.float32),
+            "samples": np.ascontiguousarray(samples, dtype=np.float32),
+            "offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            "ann": ann,
+        })
+
+    def search(self, queries, k=1, threshold=None):
+        """
+        Matches each query embedding against the student templates (cosine distance).
+        Returns one list per query of (usn, distance) pairs, best first, at most k long.
+        A match must be within the student's adaptive threshold and, if given,
+        within threshold as well.
+        """
+        snapshot = self._snapshot
+        labels = snapshot["labels"]
+        queries = self._normalize(queries)
+        if len(labels) == 0:
+            return [[] for _ in range(len(queries))]
+
+        # Look a little past k so ambiguous runners-up can still be re-ranked
+        fetch = min(len(labels), k + 4)
+
+        if snapshot["ann"] is not None:
+            idx, dist = snapshot["ann"].knn_query(queries, k=fetch)
+        else:
+            dist = 1.0 - queries @ snapshot["centroids"].T
+            if fetch < len(labels):
+                idx = np.argpartition(dist, fetch - 1, axis=1)[:, :fetch]
+            else:
+                idx = np.tile(np.arange(len(labels)), (len(queries), 1))
+            dist = np.take_along_axis(dist, idx, axis=1)
+
+        results = []
+        for query, row_idx, row_dist in zip(queries, idx, dist):
+            order = np.argsort(row_dist)
+            candidates = [(int(row_idx[i]), float(row_dist[i])) for i in order]
+            candidates = self._resolve_ambiguous(snapshot, query, candidates)
+
+            matches = []
+            for student, distance in candidates:
+                limit = snapshot["thresholds"][student]
+                if threshold is not None:
+                    limit = min(limit, threshold)
+                if distance > limit:
+                    continue
+                matches.append((labels[student], distance))
+                if len(matches) >= k:
+                    break
+            results.append(matches)
+        return results
+
+    def _resolve_ambiguous(self, snapshot, query, candidates):
+        """
+        Centroid ranking is final when the winner is clearly ahead and clearly
+        inside (or outside) its threshold. Otherwise, every candidate close to
+        the top is re-scored by its nearest individual sample.
+        """
+        best_student, best_distance = candidates[0]
+        runner_up = candidates[1][1] if len(candidates) > 1 else np.inf
+        close_call = runner_up - best_distance < self.ambiguity_margin
+        near_threshold = abs(best_distance - snapshot["thresholds"][best_student]) < self.ambiguity_margin
+        if not close_call and not near_threshold:
+            return candidates
+
+        offsets = snapshot["offsets"]
+        rescored = []
+        for student, distance in candidates:
+            if distance - best_distance < self.ambiguity_margin * 2:
+                own = snapshot["samples"][offsets[student]:offsets[student + 1]]
+                distance = min(distance, float(1.0 - (own @ query).max()))
+            rescored.append((student, distance))
+        rescored.sort(key=lambda c: c[1])
+        return rescored
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+STORE_FORMAT = 1
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_write(path, write):
+    """Writes via a temp file in the same folder and renames it over path."""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".store-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class EmbeddingStore:
+    """
+    On-disk cache of face embeddings, one row per enrollment photo.
+
+        faces/embeddings_meta.json   config (model, detector, normalization, format)
+                                     + rows [{usn, source, sha1, size, mtime}] + data file name
+        faces/embeddings-<gen>.npy   float32 matrix, row i belongs to rows[i]
+
+    The matrix is memory-mapped on load. Each save writes a new .npy, then
+    atomically renames the metadata over the old one; that rename is the commit
+    point, so a reader sees either the old or the new store, never a mix.
+    Rows are reused as long as the photo (size/mtime, else sha1) and the model
+    config are unchanged, so a restart re-embeds nothing.
+
+    refresh/add_many/remove take an optional EmbeddingIndex and update it
+    before releasing the store lock, so concurrent writers (/sync and
+    enrollment) reach the index in the same order as the store and an older
+    template can't overwrite a newer one.
+    """
+
+    META_NAME = "embeddings_meta.json"
+
+    def __init__(self, directory, config):
+        self.directory = directory
+        self.config = dict(config, format=STORE_FORMAT)
+        self.meta_path = os.path.join(directory, self.META_NAME)
+        self._lock = threading.Lock()
+        self.rows = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.data_file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get("config") != self.config:
+                print("Embedding store was built with a different model config; it will be rebuilt.")
+                return
+            vectors = np.load(os.path.join(self.directory, meta["data_file"]), mmap_mode='r')
+            if len(vectors) != len(meta["rows"]):
+                print("Embedding store rows don't match its data file; it will be rebuilt.")
+                return
+            self.rows = meta["rows"]
+            self.vectors = vectors
+            self.data_file = meta["data_file"]
+            print(f"Embedding store loaded: {len(self.rows)} embeddings")
+        except Exception as e:
+            print(f"Embedding store unreadable, it will be rebuilt: {e}")
+
+    def local_usns(self):
+        return [folder for folder in os.listdir(self.directory)
+                if os.path.isdir(os.path.join(self.directory, folder)) and not folder.startswith('.')]
+
+    def refresh(self, embed_images, usns=None, batch_size=32, index=None):
+        """
+        Brings the rows for the given USNs (default: every folder on disk) in
+        line with the photos in faces/<USN>/. Only new or changed photos go
+        through embed_images(paths) -> (embedded_paths, vectors).
+        Returns {usn: samples} for every USN that was checked, also replaced in index if given.
+        """
+        with self._lock:
+            if usns is None:
+                # Everything on disk, plus stored students whose folder is gone (dropped below)
+                usns = set(self.local_usns()) | {row["usn"] for row in self.rows}
+            usns = set(usns)
+            existing = {row["source"]: i for i, row in enumerate(self.rows)}
+
+            kept = []  # (row, vector)
+            to_embed = []  # (row without vector, path)
+            rehashed = False
+            for usn in sorted(usns):
+                student_dir = os.path.join(self.directory, usn)
+                if not os.path.isdir(student_dir):
+                    continue
+                for file in sorted(os.listdir(student_dir)):
+                    if not file.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    path = os.path.join(student_dir, file)
+                    stat = os.stat(path)
+                    row = {"usn": usn, "source": f"{usn}/{file}", "size": stat.st_size, "mtime": stat.st_mtime}
+                    i = existing.get(row["source"])
+                    if i is not None and self.rows[i]["size"] == row["size"] and self.rows[i]["mtime"] == row["mtime"]:
+                        kept.append((dict(self.rows[i]), self.vectors[i]))
+                        continue
+                    row["sha1"] = file_sha1(path)
+                    if i is not None and self.rows[i]["sha1"] == row["sha1"]:
+                        # Touched but identical (e.g. re-downloaded); remember the new mtime
+                        kept.append((row, self.vectors[i]))
+                        rehashed = True
+                    else:
+                        to_embed.append((row, path))
+
+            if to_embed:
+                start_time = time.time()
+                by_path = {}
+                for start in range(0, len(to_embed), batch_size):
+                    paths = [path for _, path in to_embed[start:start + batch_size]]
+                    embedded_paths, vectors = embed_images(paths)
+                    by_path.update(zip(embedded_paths, vectors))
+                for row, path in to_embed:
+                    if path in by_path:
+                        kept.append((row, by_path[path]))
+                print(f"Embedded {len(by_path)}/{len(to_embed)} new or changed photos in {time.time() - start_time:.2f}s")
+
+            others = [i for i, row in enumerate(self.rows) if row["usn"] not in usns]
+            if to_embed or rehashed or len(kept) + len(others) != len(self.rows):
+                self._replace_rows([(self.rows[i], self.vectors[i]) for i in others] + kept)
+                self._save()
+
+            templates = {usn: [] for usn in usns}
+            for row, vector in kept:
+                templates[row["usn"]].append(vector)
+            templates = {usn: np.asarray(vectors, dtype=np.float32) for usn, vectors in templates.items()}
+            if index is not None:
+                index.replace_many(templates)
+            return templates
+
+    def remove(self, usns, index=None):
+        """Drops all rows for the given USNs (and their templates from index, if given) and persists the result."""
+        with self._lock:
+            usns = set(usns)
+            remaining = [(row, self.vectors[i]) for i, row in enumerate(self.rows) if row["usn"] not in usns]
+            if len(remaining) != len(self.rows):
+                self._replace_rows(remaining)
+                self._save()
+            if index is not None:
+                index.remove(usns)
+
+    def add_many(self, entries, save=True, index=None):
+        """
+        Stores already-computed embeddings for photos that are on disk.
+        entries: [(usn, path, vector), ...]; a row for the same photo is replaced.
+        With index, the affected students' full templates are replaced in it.
+        With save=False the caller batches several adds and calls save() later.
+        """
+        with self._lock:
+            added = {}
+            for usn, path, vector in entries:
+                stat = os.stat(path)
+                row = {"usn": usn, "source": f"{usn}/{os.path.basename(path)}", "size": stat.st_size,
+                       "mtime": stat.st_mtime, "sha1": file_sha1(path)}
+                added[row["source"]] = (row, vector)
+            remaining = [(row, self.vectors[i]) for i, row in enumerate(self.rows) if row["source"] not in added]
+            self._replace_rows(remaining + list(added.values()))
+            if save:
+                self._save()
+            if index is not None:
+                index.replace_many(self._templates({row["usn"] for row, _ in added.values()}))
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def templates(self, usns=None):
+        """{usn: samples} for the given USNs (default: everything in the store)."""
+        with self._lock:
+            return self._templates(usns)
+
+    def _templates(self, usns):
+        grouped = {usn: [] for usn in usns} if usns is not None else {}
+        for i, row in enumerate(self.rows):
+            if usns is None or row["usn"] in grouped:
+                grouped.setdefault(row["usn"], []).append(i)
+        return {usn: np.asarray(self.vectors[idx], dtype=np.float32) for usn, idx in grouped.items()}
+
+    def _replace_rows(self, pairs):
+        self.rows = [row for row, _ in pairs]
+        if pairs:
+            self.vectors = np.stack([np.asarray(vector, dtype=np.float32) for _, vector in pairs])
+        else:
+            self.vectors = np.zeros((0, self.vectors.shape[1] if self.vectors.ndim == 2 else 0), dtype=np.float32)
+
+    def _save(self):
+        previous = self.data_file
+        data_file = f"embeddings-{int(time.time() * 1000)}.npy"
+        vectors = np.ascontiguousarray(self.vectors, dtype=np.float32)
+        _atomic_write(os.path.join(self.directory, data_file), lambda f: np.save(f, vectors))
+        meta = {"config": self.config, "data_file": data_file, "rows": self.rows}
+        _atomic_write(self.meta_path, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        self.data_file = data_file
+        self._cleanup(keep={data_file, previous})
+
+    def _cleanup(self, keep):
+        # The previous file may still be mapped by a reader (or locked on Windows); drop it next time
+        for name in os.listdir(self.directory):
+            if name.startswith("embeddings-") and name.endswith(".npy") and name not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
@@ -0,0 +1,254 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import face_model
+import metrics
+from image_io import decode_frame
+
+# Photos saved by enrollment are named like this; /sync leaves such folders alone
+ENROLLED_PREFIX = "enroll-"
+
+_DONE = object()
+
+
+class EnrollmentJob:
+    """Progress of one bulk enrollment, as reported by GET /enroll/jobs/<id>."""
+
+    MAX_ERRORS = 100
+
+    def __init__(self, max_queued):
+        self.id = uuid.uuid4().hex[:12]
+        self.status = "running"
+        self.received = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.students = set()
+        self.errors = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        # Accepted faces waiting for the embedding thread; bounded, so a slow model holds back the upload
+        self._accepted = queue.Queue(maxsize=max_queued)
+        self._outstanding = 0
+        self._closed = False
+
+    def reject(self, usn, reason):
+        metrics.ENROLLED.inc(result="rejected")
+        with self._lock:
+            self.rejected += 1
+            if len(self.errors) < self.MAX_ERRORS:
+                self.errors.append({"usn": usn, "reason": reason})
+
+    def to_dict(self):
+        with self._lock:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "received": self.received,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "students": len(self.students),
+                "seconds": round(elapsed, 2),
+                "errors": list(self.errors),
+            }
+
+
+class EnrollmentPipeline:
+    """
+    Enrolls photos straight into the live index.
+
+    Each photo goes decode -> quality checks (exactly one face, face size,
+    sharpness) -> embedding -> faces/<USN>/enroll-<hash>.jpg + embedding store
+    + index, so nothing is left to embed later on the recognition path.
+
+    Bulk jobs are fed item by item while the upload is still streaming in:
+    decoding and checks run on a thread pool, at most max_pending photos at a
+    time, and accepted faces are embedded in batches by one thread per job,
+    with at most 2 x batch_size of them waiting. A photo's pending slot is
+    only freed once its face is queued, so when embedding falls behind,
+    feed() blocks and the upload is read no faster than it is embedded.
+    Detection and embedding calls from all jobs share model_concurrency
+    slots, so enrollment never holds more than that many model-pool slots and
+    the rest stay free for live recognition.
+    """
+
+    def __init__(self, faces_dir, index, store, get_embedder, on_update=None, workers=4, batch_size=32,
+                 max_pending=64, model_concurrency=1, min_face=80, min_sharpness=60.0):
+        self.faces_dir = faces_dir
+        self.index = index
+        self.store = store
+        # A callable, because serve.py swaps the embedder after import
+        self.get_embedder = get_embedder
+        # Called with the set of USNs whose templates changed
+        self.on_update = on_update
+        self.batch_size = batch_size
+        self.min_face = min_face
+        self.min_sharpness = min_sharpness
+        self._inspect_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enroll")
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._model_slots = threading.BoundedSemaphore(model_concurrency)
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+
+    # --- single photo ---
+
+    def inspect(self, usn, image_bytes):
+        """
+        Decodes and quality-checks one photo.
+        Returns (face_crop, None) when usable, else (None, reason).
+        """
+        if not usn or not isinstance(usn, str) or os.sep in usn or "/" in usn or usn.startswith("."):
+            return None, "Invalid USN"
+        if not image_bytes:
+            return None, "Missing image"
+        img = decode_frame(image_bytes, max_side=None)
+        if img is None:
+            return None, "Invalid image format"
+        with self._model_slots, metrics.stage("enroll_detection"):
+            faces = [(area, face) for area, face in self.get_embedder().detect_faces(img)
+                     if not face_model.is_placeholder(area, img)]
+        if len(faces) == 0:
+            return None, "No face detected"
+        if len(faces) > 1:
+            return None, f"{len(faces)} faces detected, expected one"
+        area, face = faces[0]
+        # float64 from detection; float32 halves what queued faces hold and is what the model takes
+        face = np.ascontiguousarray(face, dtype=np.float32)
+        if min(area["w"], area["h"]) < self.min_face:
+            return None, f"Face too small ({min(area['w'], area['h'])}px, need {self.min_face}px)"
+        region = img[area["y"]:area["y"] + area["h"], area["x"]:area["x"] + area["w"]]
+        sharpness = cv2.Laplacian(cv2.cvtColor(region, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
+        if sharpness < self.min_sharpness:
+            return None, f"Image too blurry (sharpness {sharpness:.0f}, need {self.min_sharpness:.0f})"
+        return face, None
+
+    def enroll_one(self, usn, image_bytes):
+        """Synchronous single-photo enrollment. Returns None on success, else the rejection reason."""
+        face, reason = self.inspect(usn, image_bytes)
+        if reason:
+            metrics.ENROLLED.inc(result="rejected")
+            return reason
+        self._commit([(usn, image_bytes, face)], save=True)
+        return None
+
+    def _commit(self, accepted, save):
+        """Embeds a batch of accepted (usn, bytes, face) and makes them live."""
+        with self._model_slots, metrics.stage("enroll_embedding"):
+            vectors = self.get_embedder().embed_faces([face for _, _, face in accepted])
+        entries = []
+        for (usn, image_bytes, _), vector in zip(accepted, vectors):
+            student_dir = os.path.join(self.faces_dir, usn)
+            os.makedirs(student_dir, exist_ok=True)
+            # Named by content, so uploading the same photo twice doesn't add a duplicate sample
+            path = os.path.join(student_dir, f"{ENROLLED_PREFIX}{hashlib.sha1(image_bytes).hexdigest()[:12]}.jpg")
+            with open(path, 'wb') as f:
+                f.write(image_bytes)
+            entries.append((usn, path, vector))
+        # Store and index change together, so a concurrent /sync can't put an older template back
+        self.store.add_many(entries, save=save, index=self.index)
+        usns = {usn for usn, _, _ in entries}
+        metrics.ENROLLED.inc(len(entries), result="accepted")
+        if self.on_update:
+            self.on_update(usns)
+        return usns
+
+    # --- bulk jobs ---
+
+    def start_job(self):
+        job = EnrollmentJob(max_queued=2 * self.batch_size)
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            # Keep the most recent jobs only
+            for old_id in list(self._jobs)[:-50]:
+                if self._jobs[old_id].status != "running":
+                    del self._jobs[old_id]
+        threading.Thread(target=self._embed_loop, args=(job,), daemon=True, name=f"enroll-{job.id}").start()
+        return job
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def feed(self, job, usn, image_bytes):
+        """Queues one photo; blocks while max_pending photos are still being checked or waiting to be queued."""
+        self._pending.acquire()
+        with job._lock:
+            job.received += 1
+            job._outstanding += 1
+        future = self._inspect_pool.submit(self.inspect, usn, image_bytes)
+        future.add_done_callback(lambda f: self._inspected(job, usn, image_bytes, f))
+
+    def skip(self, job, reason):
+        """Counts an upload entry that couldn't even be read (no USN to report) as received and rejected."""
+        with job._lock:
+            job.received += 1
+        job.reject(None, reason)
+
+    def _inspected(self, job, usn, image_bytes, future):
+        try:
+            face, reason = future.result()
+        except Exception as e:
+            face, reason = None, f"Error: {e}"
+        try:
+            if reason:
+                job.reject(usn, reason)
+            else:
+                # Blocks while the embedding thread is behind; the slot stays taken until then
+                job._accepted.put((usn, image_bytes, face))
+        finally:
+            self._pending.release()
+        with job._lock:
+            job._outstanding -= 1
+            finished = job._closed and job._outstanding == 0
+        if finished:
+            job._accepted.put(_DONE)
+
+    def finish(self, job):
+        """No more photos for this job; it completes once everything queued is embedded."""
+        with job._lock:
+            job._closed = True
+            finished = job._outstanding == 0
+        if finished:
+            job._accepted.put(_DONE)
+
+    def _embed_loop(self, job):
+        batch = []
+        done = False
+        while not done:
+            try:
+                item = job._accepted.get(timeout=0.5)
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                done = True
+            elif item is not None:
+                batch.append(item)
+            # Flush when the batch is full, the feed went quiet, or the job is over
+            if batch and (len(batch) >= self.batch_size or item is None or done):
+                try:
+                    usns = self._commit(batch, save=False)
+                    with job._lock:
+                        job.accepted += len(batch)
+                        job.students.update(usns)
+                except Exception as e:
+                    for usn, _, _ in batch:
+                        job.reject(usn, f"Error: {e}")
+                batch = []
+        try:
+            self.store.save()
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.reject(None, f"Could not save embedding store: {e}")
+        job.finished_at = time.time()
+        print(f"Enrollment job {job.id} finished: {job.accepted} accepted, {job.rejected} rejected "
+              f"in {job.finished_at - job.started_at:.1f}s")
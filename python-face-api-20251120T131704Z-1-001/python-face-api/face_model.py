@@ -0,0 +1,147 @@
+import os
+import threading
+
+import numpy as np
+from deepface import DeepFace
+from deepface.modules import preprocessing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# The face pipeline is decode -> detect -> align -> embed -> match. Decoding lives in
+# image_io and matching in embedding_index; this module owns detect/align/embed.
+# Recognition, enrollment, sync and the benchmark all read the same settings, so
+# stored embeddings always come from the same pipeline that embeds live frames.
+#
+#   FACE_DETECTOR       any DeepFace detector backend: opencv (default), yunet, ssd, mediapipe, retinaface, ...
+#   FACE_ALIGN          1 (default) to rotate faces upright using the eye landmarks
+#   FACE_MODEL          DeepFace model name: VGG-Face (default), Facenet, Facenet512, ArcFace, SFace, ...
+#   FACE_EMBEDDER       deepface (default, TensorFlow) or onnx (ONNX Runtime)
+#   FACE_ONNX_PATH      exported model for the onnx embedder (NHWC input, same preprocessing as FACE_MODEL)
+#   FACE_NORMALIZATION  DeepFace input normalization (default "base")
+MODEL_NAME = os.environ.get("FACE_MODEL", "VGG-Face")
+DETECTOR_BACKEND = os.environ.get("FACE_DETECTOR", "opencv")
+NORMALIZATION = os.environ.get("FACE_NORMALIZATION", "base")
+ALIGN = os.environ.get("FACE_ALIGN", "1") == "1"
+EMBEDDER = os.environ.get("FACE_EMBEDDER", "deepface")
+ONNX_PATH = os.environ.get("FACE_ONNX_PATH")
+
+# Everything that changes the embeddings; stored embeddings built with another config are discarded
+MODEL_CONFIG = {
+    "model": MODEL_NAME,
+    "detector": DETECTOR_BACKEND,
+    "normalization": NORMALIZATION,
+    "align": ALIGN,
+    "embedder": EMBEDDER,
+    "onnx": os.path.basename(ONNX_PATH) if EMBEDDER == "onnx" and ONNX_PATH else None,
+}
+
+
+def default_threshold():
+    """Cosine distance cut-off for the configured model."""
+    if MODEL_NAME == "VGG-Face":
+        return 0.6  # What we have always run VGG-Face with (stricter than DeepFace's 0.68)
+    from deepface.modules import verification
+    return verification.find_threshold(MODEL_NAME, "cosine")
+
+
+class DeepFaceEmbedder:
+    """
+    Runs a DeepFace model. Keras models (VGG-Face, Facenet, ArcFace, ...) embed a
+    whole batch in one call; the others (SFace on OpenCV, Dlib) go through the
+    client's own forward() one face at a time.
+    """
+
+    def __init__(self):
+        self.client = DeepFace.build_model(model_name=MODEL_NAME)
+        # DeepFace reports (width, height); resize_image wants (height, width)
+        self.target_size = (self.client.input_shape[1], self.client.input_shape[0])
+        self.batched = hasattr(self.client.model, "predict_on_batch")
+
+    def __call__(self, batch):
+        if self.batched:
+            # Call the Keras model directly: FacialRecognition.forward only returns the first row
+            return self.client.model(batch, training=False).numpy()
+        return np.stack([np.asarray(self.client.forward(row[np.newaxis]), dtype=np.float32).reshape(-1)
+                         for row in batch])
+
+
+class OnnxEmbedder:
+    """Runs an ONNX export of the model on ONNX Runtime (usually the fastest CPU option)."""
+
+    def __init__(self):
+        import onnxruntime
+        if not ONNX_PATH:
+            raise ValueError("FACE_EMBEDDER=onnx needs FACE_ONNX_PATH")
+        options = onnxruntime.SessionOptions()
+        threads = os.environ.get("TF_NUM_INTRAOP_THREADS")  # Set per model worker by model_pool
+        if threads:
+            options.intra_op_num_threads = int(threads)
+        self.session = onnxruntime.InferenceSession(ONNX_PATH, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.target_size = (model_input.shape[1], model_input.shape[2])
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.input_name: batch.astype(np.float32)})[0]
+
+
+EMBEDDERS = {
+    "deepface": DeepFaceEmbedder,
+    "onnx": OnnxEmbedder,
+}
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Builds the configured embedder once per process and keeps it warm."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                if EMBEDDER not in EMBEDDERS:
+                    raise ValueError(f"Unknown FACE_EMBEDDER '{EMBEDDER}' (expected one of {sorted(EMBEDDERS)})")
+                _model = EMBEDDERS[EMBEDDER]()
+    return _model
+
+
+def detect_faces(img):
+    """
+    Finds and aligns faces in img (path or BGR array).
+    Returns a list of (facial_area, face) tuples, face being an aligned BGR float crop.
+    Like DeepFace.find with enforce_detection=False, a frame without a detectable
+    face yields the whole image as a single "face".
+    """
+    objs = DeepFace.extract_faces(img_path=img,
+                                  detector_backend=DETECTOR_BACKEND,
+                                  enforce_detection=False,
+                                  align=ALIGN)
+    # extract_faces hands back RGB; the model expects BGR just like DeepFace.represent feeds it
+    return [(obj["facial_area"], obj["face"][:, :, ::-1]) for obj in objs]
+
+
+def is_placeholder(area, img):
+    """True for the whole-image area detect_faces returns when no face was actually found."""
+    return area["x"] == 0 and area["y"] == 0 and area["w"] >= img.shape[1] and area["h"] >= img.shape[0]
+
+
+def preprocess(faces, target_size):
+    """Resizes/pads and normalizes face crops into one model input batch."""
+    batch = []
+    for face in faces:
+        img = preprocessing.resize_image(img=face, target_size=target_size)
+        batch.append(preprocessing.normalize_input(img=img, normalization=NORMALIZATION))
+    return np.concatenate(batch)
+
+
+def embed_faces(faces):
+    """
+    Embeds a list of face crops in one batched forward pass.
+    Returns a float32 array of shape (len(faces), dim).
+    """
+    if len(faces) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    model = get_model()
+    return np.asarray(model(preprocess(faces, model.target_size)), dtype=np.float32)
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def face_hash(face):
+    """64-bit difference hash of a face crop; survives small shifts and lighting changes."""
+    gray = face if face.ndim == 2 else cv2.cvtColor(np.asarray(face, dtype=np.float32), cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def iou(a, b):
+    """Intersection over union of two facial_area dicts ({x, y, w, h})."""
+    x1 = max(a["x"], b["x"])
+    y1 = max(a["y"], b["y"])
+    x2 = min(a["x"] + a["w"], b["x"] + b["w"])
+    y2 = min(a["y"] + a["h"], b["y"] + b["h"])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a["w"] * a["h"] + b["w"] * b["h"] - inter
+    return inter / union if union > 0 else 0.0
+
+
+class Track:
+    def __init__(self, area, fingerprint, now):
+        self.area = area
+        self.fingerprint = fingerprint
+        self.last_seen = now
+        self.usn = None
+        self.distance = None
+        self.hits = 0  # consecutive embeddings that agreed on usn
+        self.since_verify = 0  # frames served from cache since the last embedding
+
+
+class FaceTracker:
+    """
+    Short-lived face tracks per kiosk session.
+    Faces in a new frame are associated with the previous frame's faces by box
+    overlap (IoU) and a perceptual hash of the crop. Once a track has been
+    embedded to the same USN confirm_hits times in a row, its identity is
+    reused and the embedding model is skipped, re-verifying every refresh_every
+    frames. A track missing from a frame (a missed detection, someone turning
+    away) is kept until it has been unseen for ttl seconds; each session keeps
+    at most max_tracks tracks and at most max_sessions sessions are kept
+    (least recently used dropped first).
+    """
+
+    def __init__(self, ttl=10.0, max_sessions=256, max_tracks=32, iou_threshold=0.5, max_hash_distance=12,
+                 confirm_hits=2, refresh_every=10):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_tracks = max_tracks
+        self.iou_threshold = iou_threshold
+        self.max_hash_distance = max_hash_distance
+        self.confirm_hits = confirm_hits
+        self.refresh_every = refresh_every
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_confirmed(self, track):
+        return (track.usn is not None and track.hits >= self.confirm_hits
+                and track.since_verify < self.refresh_every)
+
+    def associate(self, session_id, faces):
+        """
+        Matches detected faces [(facial_area, face), ...] to this session's tracks.
+        Returns one Track per face (a fresh one when nothing matched).
+        """
+        now = time.time()
+        fingerprints = [face_hash(face) for _, face in faces]
+        with self._lock:
+            previous = [t for t in self._sessions.pop(session_id, []) if now - t.last_seen <= self.ttl]
+
+            # Greedy: best-overlapping pairs first
+            pairs = []
+            for i, (area, _) in enumerate(faces):
+                for j, track in enumerate(previous):
+                    overlap = iou(area, track.area)
+                    if overlap >= self.iou_threshold and hamming(fingerprints[i], track.fingerprint) <= self.max_hash_distance:
+                        pairs.append((overlap, i, j))
+            pairs.sort(reverse=True)
+
+            tracks = [None] * len(faces)
+            used = set()
+            for _, i, j in pairs:
+                if tracks[i] is None and j not in used:
+                    tracks[i] = previous[j]
+                    used.add(j)
+
+            for i, (area, _) in enumerate(faces):
+                if tracks[i] is None:
+                    tracks[i] = Track(area, fingerprints[i], now)
+                else:
+                    tracks[i].area = area
+                    tracks[i].fingerprint = fingerprints[i]
+                    tracks[i].last_seen = now
+
+            # Unmatched tracks stay (most recently seen first) so one missed detection doesn't reset them
+            unseen = sorted((t for j, t in enumerate(previous) if j not in used), key=lambda t: t.last_seen, reverse=True)
+            self._sessions[session_id] = (tracks + unseen)[:self.max_tracks]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return tracks
+
+    def reuse(self, track):
+        """Marks a confirmed track as served from cache; returns its (usn, distance)."""
+        track.since_verify += 1
+        return track.usn, track.distance
+
+    def record(self, track, match):
+        """Feeds a fresh embedding result ((usn, distance) or None) back into the track."""
+        usn = match[0] if match else None
+        if usn is not None and usn == track.usn:
+            track.hits += 1
+        else:
+            track.hits = 1 if usn is not None else 0
+        track.usn = usn
+        track.distance = match[1] if match else None
+        track.since_verify = 0
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
@@ -0,0 +1,99 @@
+import base64
+import struct
+
+import cv2
+import numpy as np
+
+import metrics
+
+# Longest side the face detector needs; bigger frames are decoded at reduced scale
+DETECT_MAX_SIDE = 640
+
+_REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# Start-of-frame markers carry the image size (baseline, progressive, lossless, ...)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(buf):
+    """Reads (width, height) from a JPEG header without decoding it. None if not a JPEG."""
+    view = memoryview(buf)
+    if len(view) < 4 or view[0] != 0xFF or view[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 <= len(view):
+        if view[pos] != 0xFF:
+            return None
+        marker = view[pos + 1]
+        if marker == 0xFF:
+            pos += 1  # fill byte
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2  # markers without a length field
+            continue
+        length = struct.unpack(">H", view[pos + 2:pos + 4])[0]
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack(">HH", view[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def decode_frame(buf, max_side=DETECT_MAX_SIDE):
+    """
+    Decodes JPEG/PNG bytes into a BGR array no larger than needed for detection.
+    For JPEGs libjpeg scales down during decoding (DCT-domain 1/2, 1/4, 1/8),
+    which is much cheaper than decoding at full resolution and resizing.
+    Accepts bytes, bytearray or memoryview; the buffer is wrapped, not copied.
+    Returns None for empty or undecodable input.
+    """
+    if len(buf) == 0:
+        # cv2.imdecode asserts on an empty buffer instead of returning None
+        return None
+    arr = np.frombuffer(buf, np.uint8)
+    size = jpeg_size(buf)
+    flag = cv2.IMREAD_COLOR
+    if size is not None and max_side:
+        longest = max(size)
+        for factor, reduced_flag in _REDUCED_FLAGS:
+            if longest // factor >= max_side:
+                flag = reduced_flag
+                break
+    with metrics.stage("image_decode"):
+        return cv2.imdecode(arr, flag)
+
+
+def decode_base64(image_b64, max_side=DETECT_MAX_SIDE):
+    """Decodes a base64 image (with or without the data URL prefix)."""
+    _, _, image_data = image_b64.rpartition(",")
+    with metrics.stage("base64_decode"):
+        image_bytes = base64.b64decode(image_data)
+    return decode_frame(image_bytes, max_side)
+
+
+def read_request_frame(request, max_side=DETECT_MAX_SIDE):
+    """
+    Pulls the single frame out of a /recognize request, in any of the accepted forms:
+    raw image/jpeg (or application/octet-stream) body, multipart upload under "image",
+    or JSON {"image": "<base64 or data URL>"}.
+    Returns (frame_bgr, json_body); frame_bgr is None when no image was sent.
+    """
+    content_type = (request.mimetype or "").lower()
+    if content_type.startswith("image/") or content_type == "application/octet-stream":
+        body = request.get_data(cache=False)
+        return (decode_frame(body, max_side) if body else None), {}
+    if content_type == "multipart/form-data":
+        upload = request.files.get("image")
+        return (decode_frame(upload.read(), max_side) if upload else None), request.form.to_dict()
+    data = request.get_json(silent=True) or {}
+    if not data.get("image"):
+        return None, data
+    try:
+        return decode_base64(data["image"], max_side), data
+    except (ValueError, AttributeError):
+        # Not valid base64 (or not a string): treated like a missing image
+        return None, data
@@ -0,0 +1,142 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import metrics
+
+
+# Seconds a worker waits at the warmup barrier for the slowest model load
+WARMUP_TIMEOUT = 600
+
+
+class PoolBusy(Exception):
+    """Raised when the pool already has max_in_flight jobs and the caller waited long enough."""
+
+
+# --- Worker side (runs inside each model process) ---
+
+_barrier = None
+
+
+def _init_worker(threads_per_worker, barrier):
+    global _barrier
+    _barrier = barrier
+    # Split the cores between workers instead of letting every TensorFlow grab them all
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads_per_worker)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    import face_model
+    face_model.get_model()
+    print(f"[worker {os.getpid()}] Model loaded")
+
+
+def _warm():
+    import face_model
+    # One dummy forward pass so the first real request doesn't pay for graph tracing
+    face_model.embed_faces([np.zeros((64, 64, 3), dtype=np.float32)])
+    # Hold this worker until every other one has warmed too, so each _warm job lands on a different process
+    _barrier.wait(timeout=WARMUP_TIMEOUT)
+    return os.getpid()
+
+
+def _detect_faces(img):
+    import face_model
+    start = time.perf_counter()
+    return face_model.detect_faces(img), time.perf_counter() - start
+
+
+def _embed_faces(faces):
+    import face_model
+    start = time.perf_counter()
+    return face_model.embed_faces(faces), time.perf_counter() - start
+
+
+# --- Server side ---
+
+class ModelPool:
+    """
+    N worker processes, each holding its own warm copy of the face model.
+    Exposes the same detect_faces / embed_faces calls as face_model, so the
+    Flask handlers don't care whether inference runs inline or here.
+
+    At most max_in_flight jobs are queued or running; callers wait up to
+    queue_timeout seconds for a slot and then get PoolBusy (surfaced as 503),
+    so a burst of kiosks can't pile up unbounded work behind each other.
+    If a worker dies (e.g. killed for memory), the pool is rebuilt and the
+    requests caught in it get PoolBusy too.
+    """
+
+    def __init__(self, workers, max_in_flight=None, queue_timeout=5.0):
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 2
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._warmed = False
+        self._executor = self._start()
+
+    def _start(self):
+        threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        # Always spawn: forking a process that already imported TensorFlow is unsafe
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                   initializer=_init_worker,
+                                   initargs=(threads_per_worker, context.Barrier(self.workers)))
+
+    def _restart(self, broken):
+        """Replaces a broken executor, once no matter how many requests saw it break."""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            print("Model pool broken (a worker died), starting new workers")
+            # New workers load their model on their first job
+            self._executor = self._start()
+            self._warmed = False
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def warmup(self):
+        """Starts every worker and blocks until each has loaded and exercised its model."""
+        futures = [self._executor.submit(_warm) for _ in range(self.workers)]
+        pids = {future.result() for future in futures}
+        if len(pids) != self.workers:
+            raise RuntimeError(f"Only {len(pids)} of {self.workers} model workers warmed up")
+        self._warmed = True
+        print(f"Model pool ready: {len(pids)} worker(s), max in-flight {self.max_in_flight}")
+
+    def _run(self, stage, fn, *args):
+        with metrics.stage("queue_wait"):
+            acquired = self._slots.acquire(timeout=self.queue_timeout)
+        if not acquired:
+            raise PoolBusy(f"Model pool busy ({self.max_in_flight} requests in flight)")
+        executor = self._executor
+        try:
+            result, seconds = executor.submit(fn, *args).result()
+        except BrokenProcessPool as e:
+            self._restart(executor)
+            raise PoolBusy(f"Model worker died, pool restarting; retry: {e}") from e
+        finally:
+            self._slots.release()
+        # Time inside the worker only, to tell model cost apart from queueing and IPC
+        metrics.STAGE_SECONDS.observe(seconds, stage=stage)
+        return result
+
+    def get_model(self):
+        """Same role as face_model.get_model: make sure the model is loaded (here, in every worker)."""
+        if not self._warmed:
+            self.warmup()
+
+    def detect_faces(self, img):
+        return self._run("worker_detection", _detect_faces, img)
+
+    def embed_faces(self, faces):
+        if len(faces) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._run("worker_embedding", _embed_faces, list(faces))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
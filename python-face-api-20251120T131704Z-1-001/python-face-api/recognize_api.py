@@ -1,16 +1,31 @@
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
-import cv2
-import numpy as np
 import os
-import glob
-import base64
 import time
-from deepface import DeepFace
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import shutil
+import threading
+import json
+import binascii
+import base64
+import tempfile
+import zipfile
+import cProfile
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from embedding_index import EmbeddingIndex
+from embedding_store import EmbeddingStore, IMAGE_EXTENSIONS
+from enrollment import EnrollmentPipeline, ENROLLED_PREFIX
+from attendance import AttendanceWriter, SupabaseBackend
+import face_model
+from model_pool import PoolBusy
+from face_tracker import FaceTracker
+from class_rosters import RosterCache
+from image_io import decode_frame, decode_base64, read_request_frame
+from sync_manifest import SyncManifest, parse_usn, object_signature
+import metrics
 
 # Load env vars
 load_dotenv()
@@ -34,193 +49,663 @@ FACES_DIR = "faces"
 if not os.path.exists(FACES_DIR):
     os.makedirs(FACES_DIR)
 
+# Cosine distance cut-off; defaults to the right value for the configured FACE_MODEL
+MATCH_THRESHOLD = float(os.environ.get("MATCH_THRESHOLD") or face_model.default_threshold())
+
+SYNC_MANIFEST_PATH = os.path.join(FACES_DIR, "sync_manifest.json")
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", "8"))  # Concurrent bucket downloads
+SYNC_PAGE_SIZE = 1000
+# One /sync at a time: two would download into and prune the same folders
+sync_lock = threading.Lock()
+MAX_BATCH_FRAMES = int(os.environ.get("MAX_BATCH_FRAMES", "32"))
+
+# Opt-in per-request cProfile dumps: set ENABLE_PROFILING=1, then send "X-Profile: 1"
+# (profiles this process only; under serve.py model time is spent in the worker processes)
+PROFILING_ENABLED = os.environ.get("ENABLE_PROFILING") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# One profiled request at a time: Python 3.12+ refuses a second active cProfile profiler
+profile_lock = threading.Lock()
+
+# Resident per-student templates (all photos + centroid). Loaded once at startup and refreshed by /sync,
+# so /recognize never touches the disk. Set ANN_MIN_FACES to switch large
+# rosters to an approximate (HNSW) centroid search when hnswlib is installed.
+ann_min_faces = os.environ.get("ANN_MIN_FACES")
+index = EmbeddingIndex(threshold=MATCH_THRESHOLD, ann_threshold=int(ann_min_faces) if ann_min_faces else None)
+
+# Per-photo embeddings persisted next to the faces, so restarts only embed what changed
+store = EmbeddingStore(FACES_DIR, face_model.MODEL_CONFIG)
+
+# Per-kiosk face tracks, so people standing still in front of the camera
+# aren't re-embedded every frame. Only used when the client sends a session id.
+tracker = FaceTracker(ttl=float(os.environ.get("TRACK_TTL", "10")),
+                      refresh_every=int(os.environ.get("TRACK_REFRESH_FRAMES", "10")))
+
+def fetch_class_roster(class_id):
+    """USNs of the students in one class, from profiles.class_id."""
+    response = supabase.table("profiles").select("usn").eq("role", "student").eq("class_id", class_id).execute()
+    return [row["usn"] for row in response.data if row.get("usn")]
+
+# Per-class partitions of the index, so a scoped /recognize only searches that class
+rosters = RosterCache(index, fetch_class_roster, ttl=float(os.environ.get("ROSTER_TTL", "300")))
+
+# Where detection/embedding runs. Inline by default (python recognize_api.py);
+# serve.py swaps in a ModelPool of worker processes with the same interface.
+embedder = face_model
+
+# Enrollment embeds at upload time and appends to the live index. ENROLL_CONCURRENCY caps
+# how many enrollment detection/embedding calls use the model at once, so recognition keeps its share.
+enrollment = EnrollmentPipeline(FACES_DIR, index, store, lambda: embedder,
+                                # Cached track identities may have been "unknown" before this student existed
+                                on_update=lambda usns: tracker.clear(),
+                                workers=int(os.environ.get("ENROLL_WORKERS", "4")),
+                                batch_size=int(os.environ.get("ENROLL_BATCH", "32")),
+                                model_concurrency=int(os.environ.get("ENROLL_CONCURRENCY", "1")),
+                                min_face=int(os.environ.get("ENROLL_MIN_FACE", "80")),
+                                min_sharpness=float(os.environ.get("ENROLL_MIN_SHARPNESS", "60")))
+
+
+# Optional server-side attendance (ATTENDANCE_WRITE_BEHIND=1): /recognize?mark=1 records the
+# matches itself, deduplicated in memory and written to Supabase in batches, instead of the
+# kiosk doing a select + insert per face. Inserts need the service role key (RLS).
+attendance = None
+if os.environ.get("ATTENDANCE_WRITE_BEHIND") == "1":
+    try:
+        attendance_client = create_client(url, os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or key)
+        attendance = AttendanceWriter(SupabaseBackend(attendance_client),
+                                      journal_path=os.environ.get("ATTENDANCE_JOURNAL", "attendance_journal.jsonl"),
+                                      batch_size=int(os.environ.get("ATTENDANCE_BATCH", "200")),
+                                      flush_interval=float(os.environ.get("ATTENDANCE_FLUSH_INTERVAL", "2")))
+        atexit.register(attendance.close)
+        print("Attendance write-behind enabled.")
+    except Exception as e:
+        print(f"Failed to init attendance writer: {e}")
+
+
+def embed_images(paths):
+    """
+    Embeds the first face of each photo, all photos in one batch.
+    Returns (embedded_paths, vectors); photos that fail to load are skipped.
+    PoolBusy propagates: a photo skipped for lack of capacity would otherwise
+    stay out of the index while the sync manifest records it as done.
+    """
+    crops = []
+    embedded_paths = []
+    for path in paths:
+        try:
+            faces = embedder.detect_faces(path)
+            if faces:
+                crops.append(faces[0][1])
+                embedded_paths.append(path)
+        except PoolBusy:
+            raise
+        except Exception as e:
+            print(f" - Could not embed {path}: {e}")
+    return embedded_paths, embedder.embed_faces(crops)
+
+
+def search_scope(data):
+    """
+    The index to search for this request. Narrowed to one class when the client
+    sends class_id (query string or body) or an explicit "usns" roster; the
+    whole college otherwise, or when the class roster can't be loaded or is empty.
+    """
+    usns = data.get("usns")
+    if isinstance(usns, list):
+        return index.subset(usns)
+    class_id = request.args.get("class_id") or data.get("class_id")
+    if not class_id:
+        return index
+    try:
+        with metrics.stage("scope"):
+            if not rosters.roster(class_id):
+                # No profile carries this class_id yet: matching everyone beats matching no one
+                return index
+            return rosters.view(class_id)
+    except Exception as e:
+        print(f"Roster for class {class_id} unavailable, searching everyone: {e}")
+        return index
+
+
+def mark_attendance(recognized_students, data):
+    """
+    Adds an "attendance" status (marked / already_marked / unknown_student / unverified) to each match
+    when write-behind is enabled and the client asked for it with mark=1 and a class_id.
+    subject_id, timetable_id and method ("auto"/"manual") describe the slot being marked.
+    """
+    def param(name):
+        return request.args.get(name) or data.get(name)
+
+    if attendance is None or not recognized_students or str(param("mark")).lower() not in ("1", "true"):
+        return
+    class_id = param("class_id")
+    if not class_id:
+        return
+    try:
+        with metrics.stage("attendance"):
+            statuses = attendance.mark([student['usn'] for student in recognized_students], class_id,
+                                       subject_id=param("subject_id"), timetable_id=param("timetable_id"),
+                                       method=param("method") or "auto")
+    except Exception as e:
+        # Recognition still answers; without a status the kiosk marks the student itself
+        print(f"Attendance Error: {e}")
+        return
+    for student in recognized_students:
+        student['attendance'] = statuses.get(student['usn'])
+
+
+def build_index():
+    """
+    Loads every student's template into the in-memory index.
+    Vectors come from the on-disk store; only photos that are new or changed
+    since it was written are run through the model.
+    """
+    start_time = time.time()
+    index.clear()
+    store.refresh(embed_images, index=index)
+    print(f"Index built: {index.sample_count} embeddings for {len(index)} students in {time.time() - start_time:.2f}s")
+
+
+def list_bucket_files(bucket):
+    """Lists every object in the bucket, paging past the storage API's default limit of 100."""
+    files = []
+    offset = 0
+    while True:
+        page = bucket.list("", {"limit": SYNC_PAGE_SIZE, "offset": offset, "sortBy": {"column": "name", "order": "asc"}})
+        if not page:
+            break
+        files.extend(page)
+        if len(page) < SYNC_PAGE_SIZE:
+            break
+        offset += SYNC_PAGE_SIZE
+    return files
+
+
+def download_face(bucket, file_name, local_path):
+    data = bucket.download(file_name)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    # Write next to the target and rename, so a half-written JPG is never embedded
+    tmp_path = local_path + ".part"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, local_path)
+
+
 @app.route("/sync", methods=["POST"])
 def sync_faces():
+    if not sync_lock.acquire(blocking=False):
+        return jsonify({"message": "Sync already running"}), 409
+    try:
+        return run_sync()
+    finally:
+        sync_lock.release()
+
+def run_sync():
     """
-    Downloads faces and ensures they are in a standard format (JPG) for DeepFace.
-    Parses USN from filenames like "USN-TIMESTAMP.jpg".
-    Prunes local folders that are no longer in the bucket.
+    Brings FACES_DIR in line with the face-images bucket, incrementally.
+    Parses USN from filenames like "USN-TIMESTAMP.jpg"; every upload is kept as
+    faces/<USN>/<name>.jpg, so a student can have several photos.
+    Only objects whose etag/size/updated_at changed since the last sync are downloaded,
+    only the affected USNs are re-embedded, and USNs that left the bucket are pruned
+    from disk and from the index. Students enrolled through /enroll are not in the
+    bucket: their folders are kept, only their bucket photos are dropped.
     """
     print("Starting Sync Process...")
     try:
-        files = supabase.storage.from_("face-images").list()
-        
-        current_usns = set()
+        bucket = supabase.storage.from_("face-images")
+        with metrics.stage("sync_list"):
+            files = list_bucket_files(bucket)
+        manifest = SyncManifest(SYNC_MANIFEST_PATH)
+
+        # Every upload is kept: a student's template is built from all of their photos
+        remote = {}
+        for file_obj in files:
+            file_name = file_obj.get('name')
+            if not file_name or file_name == ".emptyFolderPlaceholder":
+                continue
+            remote[file_name] = file_obj
+
+        current_usns = {parse_usn(file_name) for file_name in remote}
+        pending = []
+        for file_name, file_obj in remote.items():
+            usn = parse_usn(file_name)
+            signature = object_signature(file_obj)
+            local_path = os.path.join(FACES_DIR, usn, f"{os.path.splitext(file_name)[0]}.jpg")
+            if not manifest.is_current(file_name, signature, local_path):
+                pending.append((usn, file_name, local_path, signature))
 
-        if files:
-            synced_count = 0
-            for file_obj in files:
-                file_name = file_obj.get('name')
-                if not file_name or file_name == ".emptyFolderPlaceholder": 
+        # --- DOWNLOAD CHANGED FILES ---
+        print(f"Downloading {len(pending)} new/changed faces ({len(remote) - len(pending)} unchanged)...")
+        changed_usns = set()
+        downloaded_count = 0
+        failed_count = 0
+        with metrics.stage("sync_download"), ThreadPoolExecutor(max_workers=SYNC_WORKERS) as pool:
+            futures = {pool.submit(download_face, bucket, file_name, local_path): (usn, file_name, local_path, signature)
+                       for usn, file_name, local_path, signature in pending}
+            for future in as_completed(futures):
+                usn, file_name, local_path, signature = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f" - Failed to download {file_name}: {e}")
+                    failed_count += 1
                     continue
-                
-                # Parsing Logic
-                base_name = os.path.splitext(file_name)[0]
-                parts = base_name.split('-')
-                
-                real_usn = base_name 
-                if len(parts) > 1:
-                    last_part = parts[-1]
-                    if last_part.isdigit() and len(last_part) > 8: 
-                        real_usn = "-".join(parts[:-1]) 
-                    else:
-                        real_usn = base_name 
-
-                current_usns.add(real_usn)
-                
-                student_dir = os.path.join(FACES_DIR, real_usn)
-                
-                # Check if we need to update/download
-                # Simple strategy: If dir exists and has files, assume synced unless we force clear.
-                # For robust sync we can just overwrite if size diff, but for now let's just ensure existence.
-                # User asked to be consistent. Safest is to overwrite if we want to support image updates.
-                
-                if os.path.exists(student_dir):
-                    # Check if file exists inside
-                    local_file = os.path.join(student_dir, f"{real_usn}.jpg")
-                    if os.path.exists(local_file):
-                         # Optional: Skip download if exists to save bandwidth
-                         # But user said "consistency", so if they changed photo, we must re-download.
-                         pass
-                else:
-                    os.makedirs(student_dir)
-                
-                local_path = os.path.join(student_dir, f"{real_usn}.jpg")
-                
-                # Always download to ensure latest version
-                # print(f"Downloading {file_name} -> {local_path}...")
-                data = supabase.storage.from_("face-images").download(file_name)
-                with open(local_path, 'wb+') as f:
-                    f.write(data)
-                synced_count += 1
-        
+                # Earlier syncs may have stored this object under another name
+                previous = manifest.entries.get(file_name)
+                if previous and previous.get("local_path") != local_path and os.path.exists(previous["local_path"]):
+                    os.remove(previous["local_path"])
+                manifest.record(file_name, usn, local_path, signature)
+                changed_usns.add(usn)
+                downloaded_count += 1
+
+        # Photos deleted from the bucket for students who still have others
+        for file_name, entry in list(manifest.entries.items()):
+            if file_name not in remote and entry.get("usn") in current_usns:
+                if os.path.exists(entry.get("local_path", "")):
+                    os.remove(entry["local_path"])
+                manifest.forget(file_name)
+                changed_usns.add(entry["usn"])
+
+        # Photos the manifest doesn't know about (e.g. faces/<USN>/<USN>.jpg from before
+        # per-object files) would linger in the template; enrolled photos are kept
+        tracked = {os.path.normpath(entry["local_path"]) for entry in manifest.entries.values() if entry.get("local_path")}
+        for usn in current_usns:
+            student_dir = os.path.join(FACES_DIR, usn)
+            if not os.path.isdir(student_dir):
+                continue
+            for file in os.listdir(student_dir):
+                path = os.path.normpath(os.path.join(student_dir, file))
+                if file.lower().endswith(IMAGE_EXTENSIONS) and not file.startswith(ENROLLED_PREFIX) and path not in tracked:
+                    print(f"Removing untracked photo: {path}")
+                    os.remove(path)
+                    changed_usns.add(usn)
+
         # --- PRUNING OLD FOLDERS ---
         # Walk through FACES_DIR and remove any folder that isn't in current_usns
         print("Pruning old data...")
         deleted_count = 0
         local_folders = [f for f in os.listdir(FACES_DIR) if os.path.isdir(os.path.join(FACES_DIR, f))]
-        
-        for folder in local_folders:
-            if folder not in current_usns and folder != ".deepface": # Avoid deleting deepface cache dir if inside
-                print(f"Removing obsolete student data: {folder}")
-                shutil.rmtree(os.path.join(FACES_DIR, folder))
-                deleted_count += 1
-
-        # Clear old representations to force rebuild
-        # Clear old representations to force rebuild
-        # Remove both old style (representations_*) and new style (ds_model_*) pickle files
-        print("Clearing DeepFace cache files...")
-        for pkl_file in glob.glob(os.path.join(FACES_DIR, "*.pkl")):
-            try:
-                os.remove(pkl_file)
-                print(f" - Deleted cache: {os.path.basename(pkl_file)}")
-            except Exception as e:
-                print(f" - Failed to delete {os.path.basename(pkl_file)}: {e}")
+        pruned_usns = set()
+
+        with metrics.stage("sync_prune"):
+            enrolled_usns = {folder for folder in local_folders
+                             if any(f.startswith(ENROLLED_PREFIX) for f in os.listdir(os.path.join(FACES_DIR, folder)))}
+            for folder in local_folders:
+                if folder not in current_usns and folder not in enrolled_usns and folder != ".deepface": # Avoid deleting deepface cache dir if inside
+                    print(f"Removing obsolete student data: {folder}")
+                    shutil.rmtree(os.path.join(FACES_DIR, folder))
+                    pruned_usns.add(folder)
+                    deleted_count += 1
+
+            for name, entry in list(manifest.entries.items()):
+                if entry.get("usn") not in current_usns:
+                    manifest.forget(name)
+                    if entry.get("usn") in enrolled_usns:
+                        if os.path.exists(entry.get("local_path", "")):
+                            os.remove(entry["local_path"])
+                        changed_usns.add(entry["usn"])
+                    else:
+                        pruned_usns.add(entry.get("usn"))
 
-        print(f"Sync complete. Updated {len(current_usns)} faces. Deleted {deleted_count} old records.")
+            # --- UPDATE INDEX ---
+            # Only the students whose photo changed are re-embedded; everyone else keeps their vectors
+            if pruned_usns:
+                store.remove(pruned_usns, index=index)
+        if changed_usns:
+            print(f"Re-embedding {len(changed_usns)} students...")
+            with metrics.stage("sync_reembed"):
+                store.refresh(embed_images, usns=changed_usns, index=index)
+        manifest.save()
+        if pruned_usns or changed_usns:
+            # Cached track identities may point at templates that just changed
+            tracker.clear()
+
+        metrics.SYNC_FILES.inc(downloaded_count, action="downloaded")
+        metrics.SYNC_FILES.inc(failed_count, action="failed")
+        metrics.SYNC_FILES.inc(len(remote) - len(pending), action="unchanged")
+        metrics.SYNC_STUDENTS.inc(len(changed_usns), action="reembedded")
+        metrics.SYNC_STUDENTS.inc(len(pruned_usns), action="pruned")
+        print(f"Sync complete. Active: {len(current_usns)}, Downloaded: {downloaded_count}, Re-embedded: {len(changed_usns)}, Failed: {failed_count}, Pruned: {deleted_count}.")
         return jsonify({
-            "message": f"Sync Complete. Active: {len(current_usns)}, Pruned: {deleted_count}", 
-            "total_files": len(files) if files else 0
+            "message": f"Sync Complete. Active: {len(current_usns)}, Updated: {len(changed_usns)}, Pruned: {deleted_count}",
+            "total_files": len(files),
+            "downloaded": downloaded_count,
+            "failed": failed_count,
+            "pruned": deleted_count
         })
         
+    except PoolBusy as e:
+        # Nothing recorded in the manifest, so the next /sync retries the same files
+        print(f"Sync aborted, model pool busy: {e}")
+        return jsonify({"message": "Sync failed, model pool busy; retry later", "error": str(e)}), 503
     except Exception as e:
         print(f"CRITICAL SYNC ERROR: {e}")
         return jsonify({"message": "Sync failed", "error": str(e)}), 500
 
 @app.route("/recognize", methods=["POST"])
 def recognize():
+    """
+    Recognizes every face in one kiosk frame.
+    The frame can be a raw image/jpeg body (preferred: no base64 overhead),
+    a multipart upload under "image", or JSON {"image": "<data URL>"}.
+    Pass class_id (query string, form or JSON) to only match that class's students,
+    and mark=1 to also record their attendance (see mark_attendance).
+    """
     try:
-        data = request.get_json()
-        if not data or 'image' not in data:
+        # Raw JPEG body, multipart upload or base64 JSON; decoded at detector resolution
+        frame_bgr, data = read_request_frame(request)
+        if frame_bgr is None:
              return jsonify({"error": "No image provided"}), 400
 
-        # Decode Image
-        image_data = data["image"].split(",")[1]
-        image_bytes = base64.b64decode(image_data)
-        np_arr = np.frombuffer(image_bytes, np.uint8)
-        frame_bgr = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        
         recognized_students = []
 
-        if not os.listdir(FACES_DIR):
+        scope = search_scope(data)
+        if len(scope) == 0:
              return jsonify([])
 
-        # Run Recognition
-        dfs = DeepFace.find(img_path=frame_bgr, 
-                          db_path=FACES_DIR, 
-                          model_name="VGG-Face", 
-                          detector_backend="opencv", 
-                          enforce_detection=False, 
-                          silent=True,
-                          threshold=0.6)
-        
-        if len(dfs) > 0:
-            for df in dfs:
-                if not df.empty:
-                    best_match = df.iloc[0]
-                    identity_path = best_match['identity'] 
-                    distance = best_match['distance']
-                    
-                    normalized = identity_path.replace('\\', '/')
-                    parts = normalized.split('/')
-                    
-                    if len(parts) >= 2:
-                        usn = parts[-2]
-                        recognized_students.append({'usn': usn, 'confidence': float(distance)})
-                        print(f"MATCH: {usn} (Dist: {distance:.4f})")
+        with metrics.stage("detection"):
+            faces = embedder.detect_faces(frame_bgr)
+
+        # Faces that are confirmed tracks from this kiosk's previous frames skip the model
+        session_id = request.headers.get("X-Kiosk-Id") or data.get("session_id")
+        with metrics.stage("tracking"):
+            tracks = tracker.associate(session_id, faces) if session_id else [None] * len(faces)
+        results = [tracker.reuse(track) if track and tracker.is_confirmed(track) else None for track in tracks]
+        if scope is not index:
+            # A track confirmed under another scope may name someone outside this class; re-match those
+            results = [result if result is None or result[0] in scope else None for result in results]
+        metrics.FACES.inc(len(faces) - results.count(None), result="cached")
+
+        # Embed the rest, then match them all in one vectorized lookup
+        pending = [i for i, result in enumerate(results) if result is None]
+        if pending:
+            with metrics.stage("embedding"):
+                embeddings = embedder.embed_faces([faces[i][1] for i in pending])
+            with metrics.stage("index_search"):
+                matches = scope.search(embeddings, k=1)
+            for i, face_matches in zip(pending, matches):
+                metrics.FACES.inc(result="matched" if face_matches else "unknown")
+                match = face_matches[0] if face_matches else None
+                if tracks[i] is not None:
+                    tracker.record(tracks[i], match)
+                results[i] = match
+
+        for result in results:
+            if result:
+                usn, distance = result
+                recognized_students.append({'usn': usn, 'confidence': float(distance)})
+                print(f"MATCH: {usn} (Dist: {distance:.4f})")
 
+        mark_attendance(recognized_students, data)
         return jsonify(recognized_students)
 
+    except PoolBusy as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Recognition Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/recognize/batch", methods=["POST"])
+def recognize_batch():
+    """
+    Recognizes a burst of frames (several cameras and/or consecutive shots) in one call.
+    Accepts either multipart/form-data with raw JPEG files under "frames",
+    or JSON {"frames": ["<base64 or data URL>", ...]}.
+    All faces from all frames go through the model as a single batch.
+    class_id (query string, form or JSON) narrows matching to one class.
+    Returns per-frame matches plus the burst deduplicated by USN (best distance wins).
+    """
+    try:
+        # Validate the count and shape before decoding anything
+        if request.files:
+            data = request.form.to_dict()
+            encoded = request.files.getlist("frames")
+        else:
+            data = request.get_json(silent=True) or {}
+            encoded = data.get('frames')
+            if not isinstance(encoded, list) or not all(isinstance(image, str) for image in encoded):
+                return jsonify({"error": "frames must be a list of base64 images"}), 400
+
+        if not encoded:
+            return jsonify({"error": "No frames provided"}), 400
+        if len(encoded) > MAX_BATCH_FRAMES:
+            return jsonify({"error": f"Too many frames (max {MAX_BATCH_FRAMES})"}), 413
+
+        if request.files:
+            encoded = [f.read() for f in encoded]
+        if not all(encoded):
+            return jsonify({"error": "Empty frame"}), 400
+        try:
+            frames = [decode_frame(buf) for buf in encoded] if request.files else [decode_base64(image) for image in encoded]
+        except ValueError:
+            return jsonify({"error": "Invalid base64 frame"}), 400
+
+        per_frame = [[] for _ in frames]
+        scope = search_scope(data)
+        if len(scope) == 0:
+            return jsonify({"frames": per_frame, "students": []})
+
+        # Detect in every frame, remembering which frame each crop came from
+        crops = []
+        owners = []
+        with metrics.stage("detection"):
+            for frame_no, frame_bgr in enumerate(frames):
+                if frame_bgr is None:
+                    continue
+                for _, face in embedder.detect_faces(frame_bgr):
+                    crops.append(face)
+                    owners.append(frame_no)
+
+        best = {}
+        if crops:
+            with metrics.stage("embedding"):
+                embeddings = embedder.embed_faces(crops)
+            with metrics.stage("index_search"):
+                matches = scope.search(embeddings, k=1)
+            for frame_no, face_matches in zip(owners, matches):
+                if not face_matches:
+                    continue
+                usn, distance = face_matches[0]
+                per_frame[frame_no].append({'usn': usn, 'confidence': float(distance)})
+                seen = best.setdefault(usn, {'usn': usn, 'confidence': float(distance), 'frames': 0})
+                seen['confidence'] = min(seen['confidence'], float(distance))
+                seen['frames'] += 1
+
+        print(f"BATCH: {len(frames)} frames, {len(crops)} faces, {len(best)} students")
+        return jsonify({"frames": per_frame, "students": sorted(best.values(), key=lambda s: s['confidence'])})
+
+    except PoolBusy as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        print(f"Batch Recognition Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+def usn_from_path(name):
+    """USN for a bulk-upload entry: its folder ("USN/photo.jpg"), else the file name ("USN-TIMESTAMP.jpg")."""
+    parts = [part for part in name.replace("\\", "/").split("/") if part]
+    if len(parts) > 1:
+        return parts[-2]
+    return parse_usn(parts[-1]) if parts else None
+
+
+# Yielded by iter_bulk_upload as (_MALFORMED, line_number) for an NDJSON line that isn't {"usn", "image"}
+_MALFORMED = object()
+
+def iter_bulk_upload():
+    """
+    Yields (usn, image_bytes) from a bulk enrollment upload while it is being read:
+    multipart "images" files (form field "usn" for all of them, else per file name),
+    a zip archive (application/zip), or NDJSON lines {"usn": ..., "image": "<base64>"}.
+    Unreadable entries are yielded too (NDJSON: (_MALFORMED, line_number)) so they are reported, not dropped.
+    """
+    content_type = (request.mimetype or "").lower()
+    if content_type == "multipart/form-data":
+        form_usn = request.form.get("usn")
+        for upload in request.files.getlist("images"):
+            yield form_usn or usn_from_path(upload.filename or ""), upload.read()
+    elif content_type in ("application/zip", "application/x-zip-compressed"):
+        # Zip needs random access to its directory; spool to disk past 64 MB
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+            shutil.copyfileobj(request.stream, spool)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    yield usn_from_path(info.filename), archive.read(info)
+    elif content_type in ("application/x-ndjson", "application/jsonl"):
+        for line_number, line in enumerate(request.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                entry = item.get("usn"), base64.b64decode((item.get("image") or "").rpartition(",")[2])
+            except (ValueError, AttributeError, binascii.Error):
+                entry = _MALFORMED, line_number
+            yield entry
+    else:
+        raise ValueError("Send multipart images, a zip archive or NDJSON")
+
+
+@app.route("/enroll", methods=["POST"])
+def enroll_person():
+    """
+    Enrolls one photo: {"usn": "...", "image": "<base64 or data URL>"}.
+    The face is checked, embedded and searchable as soon as this returns.
+    """
+    data = request.get_json(silent=True) or {}
+    usn = data.get('usn')
+    image_data = data.get('image')
+    if not usn or not image_data:
+        return jsonify({'message': 'Name or image data is missing'}), 400
+    try:
+        image_bytes = base64.b64decode(image_data.rpartition(",")[2])
+    except (ValueError, binascii.Error):
+        return jsonify({'message': 'Invalid image format'}), 400
+    try:
+        reason = enrollment.enroll_one(usn, image_bytes)
+    except PoolBusy as e:
+        return jsonify({'message': str(e)}), 503
+    except Exception as e:
+        print(f"Enrollment Error: {e}")
+        return jsonify({'message': 'Enrollment failed', 'error': str(e)}), 500
+    if reason:
+        return jsonify({'message': reason}), 400
+    print(f"[INFO] Enrolled {usn}")
+    return jsonify({'message': 'Enrollment complete'}), 200
+
+@app.route("/enroll/bulk", methods=["POST"])
+def enroll_bulk():
+    """
+    Starts a bulk enrollment job (see iter_bulk_upload for the accepted formats).
+    Photos are checked while the upload streams in; embedding finishes in the
+    background, so this returns 202 with a job id to poll at /enroll/jobs/<id>.
+    """
+    job = enrollment.start_job()
+    try:
+        for usn, image_bytes in iter_bulk_upload():
+            if usn is _MALFORMED:
+                enrollment.skip(job, f"Malformed NDJSON line {image_bytes}")
+            else:
+                enrollment.feed(job, usn, image_bytes)
+    except ValueError as e:
+        return jsonify({"error": str(e), "job_id": job.id}), 400
+    except zipfile.BadZipFile:
+        return jsonify({"error": "Invalid zip archive", "job_id": job.id}), 400
+    finally:
+        enrollment.finish(job)
+    return jsonify({**job.to_dict(), "status_url": f"/enroll/jobs/{job.id}"}), 202
+
+@app.route("/enroll/jobs/<job_id>", methods=["GET"])
+def enroll_job_status(job_id):
+    job = enrollment.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/rosters", methods=["GET", "POST"])
+def class_rosters():
+    """
+    POST {"class_id": "...", "usns": [...]} pushes a class roster, overriding the
+    one read from Supabase. GET lists the rosters currently cached and their sizes.
+    """
+    if request.method == "GET":
+        return jsonify(rosters.sizes())
+    data = request.get_json(silent=True) or {}
+    if not data.get("class_id") or not isinstance(data.get("usns"), list):
+        return jsonify({"error": "class_id and usns are required"}), 400
+    rosters.push(data["class_id"], data["usns"])
+    return jsonify({"class_id": data["class_id"], "students": len(data["usns"])})
+
+@app.route("/rosters/<class_id>", methods=["DELETE"])
+def forget_class_roster(class_id):
+    rosters.forget(class_id)
+    return jsonify({"class_id": class_id, "message": "Roster dropped"})
+
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok"})
 
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+metrics.gauge("face_api_index_students", "Students in the in-memory index", lambda: len(index))
+metrics.gauge("face_api_index_embeddings", "Embeddings (photos) in the in-memory index", lambda: index.sample_count)
+metrics.gauge("face_api_attendance_pending", "Attendance rows waiting to be written",
+              lambda: attendance.pending if attendance else 0)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if PROFILING_ENABLED and request.headers.get("X-Profile"):
+        if profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            g.profile_skipped = True
+
+@app.after_request
+def record_request(response):
+    profiler = g.get("profiler")
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        endpoint = (request.endpoint or "unknown").replace("/", "_")
+        path = os.path.join(PROFILE_DIR, f"{endpoint}-{int(time.time() * 1000)}.prof")
+        profiler.dump_stats(path)
+        response.headers["X-Profile-File"] = path
+        print(f"Profile written: {path}")
+    elif g.pop("profile_skipped", False):
+        response.headers["X-Profile-Skipped"] = "another profile is running"
+    if "request_start" in g and request.endpoint != "prometheus_metrics":
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                        endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
+@app.teardown_request
+def release_profiler(exc):
+    # Also runs when the view raised and after_request was skipped
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+
 
 def warmup():
     """
-    Forces DeepFace to build the representations cache file (.pkl) on startup.
-    This prevents race conditions where multiple requests try to write the file simultaneously.
+    Loads the face model and embeds the local roster into the in-memory index on startup,
+    so the first /recognize call doesn't pay for either.
     """
     print("--- WARMING UP FACE MODEL ---")
-    
-    # Safety: Clean up existing cache files to prevent permission errors
-    # This ensures we start with a fresh writeable cache
-    for pkl in glob.glob(os.path.join(FACES_DIR, "ds_model_*.pkl")):
-        try:
-            os.remove(pkl)
-            print(f"Startup clean: Removed {os.path.basename(pkl)}")
-        except Exception as e:
-            print(f"Startup clean warn: Could not remove {os.path.basename(pkl)} - {e}")
     try:
+        embedder.get_model()
+
         if not os.path.exists(FACES_DIR) or not os.listdir(FACES_DIR):
             print("No faces found to warm up with. Skipping.")
             return
 
-        # Find first available image
-        sample_img = None
-        for root, dirs, files in os.walk(FACES_DIR):
-            for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    sample_img = os.path.join(root, file)
-                    break
-            if sample_img: break
-        
-        if sample_img:
-            print(f"Running warmup on {sample_img}...")
-            # Run find once to trigger pickle generation
-            DeepFace.find(img_path=sample_img, 
-                          db_path=FACES_DIR, 
-                          model_name="VGG-Face", 
-                          detector_backend="opencv", 
-                          enforce_detection=False, 
-                          silent=True)
-            print("--- WARMUP COMPLETE: Model cache generated safely ---")
-        else:
-            print("No suitable images found for warmup.")
+        build_index()
+        print("--- WARMUP COMPLETE: Embedding index loaded ---")
 
     except Exception as e:
         print(f"Warmup warning: {e}")
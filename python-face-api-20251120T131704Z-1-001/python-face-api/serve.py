@@ -0,0 +1,52 @@
+"""
+Production entry point for the Face Recognition API.
+
+    python serve.py
+
+Runs the same Flask app as recognize_api.py, but behind the waitress WSGI server
+(multi-threaded, works on Windows) with face detection/embedding offloaded to a
+pool of model worker processes. The embedding index stays in this process and is
+swapped in place by /sync, so no restart is needed after a sync.
+
+Settings (environment / .env):
+    HOST, PORT          where to listen (default 0.0.0.0:5006)
+    MODEL_WORKERS       model processes, each with its own warm model (default: half the cores)
+    MAX_IN_FLIGHT       model jobs queued or running before callers wait (default: 2 x workers)
+    QUEUE_TIMEOUT       seconds to wait for a free slot before answering 503 (default 5)
+    HTTP_THREADS        waitress request threads (default: MAX_IN_FLIGHT + 4)
+"""
+import os
+
+from dotenv import load_dotenv
+from waitress import serve
+
+from model_pool import ModelPool
+
+
+def main():
+    load_dotenv()
+    # Imported here so spawned model workers don't re-create the Flask app and Supabase client
+    import recognize_api
+
+    workers = int(os.environ.get("MODEL_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+    max_in_flight = int(os.environ.get("MAX_IN_FLIGHT", workers * 2))
+    queue_timeout = float(os.environ.get("QUEUE_TIMEOUT", "5"))
+    http_threads = int(os.environ.get("HTTP_THREADS", max_in_flight + 4))
+    host = os.environ.get("HOST", "0.0.0.0")
+    port = int(os.environ.get("PORT", "5006"))
+
+    pool = ModelPool(workers=workers, max_in_flight=max_in_flight, queue_timeout=queue_timeout)
+    recognize_api.embedder = pool
+    try:
+        # Workers are fully loaded before the first request is accepted; a pool that
+        # can't start fails the process here instead of answering every request with errors
+        pool.warmup()
+        recognize_api.warmup()
+        print(f"Serving on http://{host}:{port} ({http_threads} HTTP threads)")
+        serve(recognize_api.app, host=host, port=port, threads=http_threads)
+    finally:
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
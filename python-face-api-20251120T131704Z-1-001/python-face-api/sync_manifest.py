@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+
+
+def parse_usn(file_name):
+    """
+    Extracts the USN from a bucket object name.
+    Uploads are named "USN-TIMESTAMP.jpg"; anything else is taken as the USN itself.
+    """
+    base_name = os.path.splitext(file_name)[0]
+    parts = base_name.split('-')
+    if len(parts) > 1:
+        last_part = parts[-1]
+        if last_part.isdigit() and len(last_part) > 8:
+            return "-".join(parts[:-1])
+    return base_name
+
+
+def object_signature(file_obj):
+    """What we compare to decide if a bucket object changed since the last sync."""
+    metadata = file_obj.get('metadata') or {}
+    return {
+        "etag": metadata.get('eTag'),
+        "size": metadata.get('size'),
+        "updated_at": file_obj.get('updated_at'),
+    }
+
+
+class SyncManifest:
+    """
+    Remembers which bucket objects are already on disk, keyed by object name:
+        {name: {"usn", "local_path", "etag", "size", "updated_at"}}
+    Saved next to the faces so a restart doesn't force a full re-download.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"Sync manifest unreadable, starting fresh: {e}")
+                self.entries = {}
+
+    def is_current(self, name, signature, local_path):
+        entry = self.entries.get(name)
+        if not entry or entry.get("local_path") != local_path or not os.path.exists(local_path):
+            return False
+        return all(entry.get(k) == v for k, v in signature.items())
+
+    def record(self, name, usn, local_path, signature):
+        self.entries[name] = {"usn": usn, "local_path": local_path, **signature}
+
+    def forget(self, name):
+        self.entries.pop(name, None)
+
+    def save(self):
+        # Write-then-rename so a crash mid-write never leaves a truncated manifest
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".manifest-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
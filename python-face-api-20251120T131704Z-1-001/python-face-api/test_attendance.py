@@ -0,0 +1,113 @@
+"""
+Attendance write-behind against the in-memory backend.
+
+    python -m pytest test_attendance.py
+"""
+import time
+
+from attendance import (ALREADY_MARKED, MARKED, UNKNOWN_STUDENT, UNVERIFIED,
+                        AttendanceWriter, MemoryBackend)
+
+STUDENTS = {"1RV21CS001": "id-1", "1RV21CS002": "id-2", "1RV21CS003": "id-3"}
+
+
+def make_writer(backend, tmp_path, **kwargs):
+    # Long interval: tests flush explicitly instead of racing the background thread
+    kwargs.setdefault("flush_interval", 60.0)
+    return AttendanceWriter(backend, str(tmp_path / "journal.jsonl"), **kwargs)
+
+
+def test_dedupes_within_slot_and_loads_slot_once(tmp_path):
+    backend = MemoryBackend(STUDENTS)
+    writer = make_writer(backend, tmp_path)
+
+    first = writer.mark(["1RV21CS001", "1RV21CS002", "1RV21CS001", "NOBODY"], "class-a", subject_id="maths")
+    assert first == {"1RV21CS001": MARKED, "1RV21CS002": MARKED, "NOBODY": UNKNOWN_STUDENT}
+    queries = backend.queries
+
+    # A second frame of the same lecture costs no database round trip
+    second = writer.mark(["1RV21CS001", "1RV21CS002"], "class-a", subject_id="maths")
+    assert second == {"1RV21CS001": ALREADY_MARKED, "1RV21CS002": ALREADY_MARKED}
+    assert backend.queries == queries
+
+    # Another timetable entry for the same subject is the same slot, like on the kiosk
+    assert writer.mark(["1RV21CS001"], "class-a", subject_id="maths", timetable_id="tt-2") == {"1RV21CS001": ALREADY_MARKED}
+    # A different subject is not
+    assert writer.mark(["1RV21CS001"], "class-a", subject_id="physics") == {"1RV21CS001": MARKED}
+
+    assert writer.flush()
+    assert sorted((row["student_id"], row["subject_id"]) for row in backend.rows) == [
+        ("id-1", "maths"), ("id-1", "physics"), ("id-2", "maths")]
+    writer.close()
+
+
+def test_rows_already_in_database_are_not_marked_again(tmp_path):
+    backend = MemoryBackend(STUDENTS)
+    earlier = AttendanceWriter(backend, str(tmp_path / "earlier.jsonl"), flush_interval=60.0)
+    earlier.mark(["1RV21CS001"], "class-a", subject_id="maths")
+    earlier.close()
+
+    # e.g. after a restart: the slot is loaded from the database
+    writer = make_writer(backend, tmp_path)
+    assert writer.mark(["1RV21CS001", "1RV21CS003"], "class-a", subject_id="maths") == {
+        "1RV21CS001": ALREADY_MARKED, "1RV21CS003": MARKED}
+    writer.close()
+    assert len(backend.rows) == 2
+
+
+def test_unloadable_slot_is_unverified_and_not_queued(tmp_path):
+    backend = MemoryBackend(STUDENTS)
+    marked = backend.marked
+
+    def outage(slot):
+        raise ConnectionError("down")
+
+    backend.marked = outage
+    writer = make_writer(backend, tmp_path)
+
+    assert writer.mark(["1RV21CS001"], "class-a", subject_id="maths") == {"1RV21CS001": UNVERIFIED}
+    assert writer.pending == 0
+
+    # Once the slot loads, marking works normally
+    backend.marked = marked
+    assert writer.mark(["1RV21CS001"], "class-a", subject_id="maths") == {"1RV21CS001": MARKED}
+    writer.close()
+    assert len(backend.rows) == 1
+
+
+def test_failed_writes_are_retried(tmp_path):
+    backend = MemoryBackend(STUDENTS)
+    backend.fail_inserts = 2
+    writer = make_writer(backend, tmp_path, flush_interval=0.05, max_backoff=0.2)
+
+    writer.mark(list(STUDENTS), "class-a", subject_id="maths")
+    deadline = time.time() + 5
+    while writer.pending and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert writer.pending == 0
+    assert backend.fail_inserts == 0
+    assert sorted(row["student_id"] for row in backend.rows) == ["id-1", "id-2", "id-3"]
+    writer.close()
+
+
+def test_journal_replays_unwritten_rows(tmp_path):
+    backend = MemoryBackend(STUDENTS)
+    backend.fail_inserts = 10 ** 6  # Supabase down for the whole first run
+    writer = make_writer(backend, tmp_path)
+    writer.mark(["1RV21CS001", "1RV21CS002"], "class-a", subject_id="maths")
+    writer.close()
+    assert backend.rows == []
+
+    # Next start, database reachable again
+    backend.fail_inserts = 0
+    restarted = make_writer(backend, tmp_path)
+    assert restarted.pending == 2
+    # Replayed rows still count as marked
+    assert restarted.mark(["1RV21CS001"], "class-a", subject_id="maths") == {"1RV21CS001": ALREADY_MARKED}
+    assert restarted.flush()
+    restarted.close()
+    assert sorted(row["student_id"] for row in backend.rows) == ["id-1", "id-2"]
+
+    # Everything was acknowledged: a third start has nothing to replay
+    assert make_writer(backend, tmp_path).pending == 0
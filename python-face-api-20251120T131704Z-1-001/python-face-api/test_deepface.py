@@ -1,51 +1,137 @@
-from deepface import DeepFace
-import cv2
+"""
+Benchmark for the face pipeline: decode -> detect/align -> embed -> match.
+
+    python test_deepface.py
+    python test_deepface.py --detector yunet --model SFace --sizes 10,100,1000,10000
+    FACE_EMBEDDER=onnx FACE_ONNX_PATH=vggface.onnx python test_deepface.py
+
+Per-stage latency (mean, p50/p95/p99) and throughput are measured on the photos
+in faces/ (or --images), and matching is measured against synthetic rosters of
+each --sizes identities, so the CPU-optimal combination can be picked with data.
+"""
+import argparse
 import os
 import time
 
-print("Starting DeepFace Test...")
+import cv2
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default="faces", help="folder with fixture photos (searched recursively)")
+    parser.add_argument("--detector", help="override FACE_DETECTOR")
+    parser.add_argument("--model", help="override FACE_MODEL")
+    parser.add_argument("--embedder", help="override FACE_EMBEDDER (deepface/onnx)")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="roster sizes (identities) for matching")
+    parser.add_argument("--samples", type=int, default=3, help="photos per synthetic identity")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per stage")
+    parser.add_argument("--batch", type=int, default=8, help="batch size for the batched embedding run")
+    parser.add_argument("--ann", action="store_true", help="also time the HNSW index (needs hnswlib)")
+    return parser.parse_args()
+
 
-# Path to an existing image
-# Try to find any jpg in faces folder
-img_path = None
-if os.path.exists("faces"):
-    for root, dirs, files in os.walk("faces"):
+def timed(fn, repeat):
+    """Runs fn once untimed (warm-up), then repeat times. Returns per-run seconds."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def report(name, times, items=1):
+    ms = times * 1000
+    print(f"{name:<34} mean {ms.mean():8.2f} ms  p50 {np.percentile(ms, 50):8.2f}  "
+          f"p95 {np.percentile(ms, 95):8.2f}  p99 {np.percentile(ms, 99):8.2f}  "
+          f"{items / times.mean():9.1f} /s")
+
+
+def find_images(folder):
+    paths = []
+    for root, dirs, files in os.walk(folder):
         for file in files:
-            if file.endswith(".jpg"):
-                img_path = os.path.join(root, file)
-                break
-        if img_path:
-            break
-
-if not img_path:
-    print("Error: No image found in faces folder to test with.")
-    exit(1)
-
-print(f"Testing with image: {img_path}")
-
-try:
-    # Test Recognition
-    print("Testing Recognition (DeepFace.find)...")
-    start_time = time.time()
-    dfs = DeepFace.find(img_path=img_path, 
-                      db_path="faces", 
-                      model_name="VGG-Face", 
-                      detector_backend="opencv", 
-                      enforce_detection=False,
-                      silent=True)
-    end_time = time.time()
-    
-    print(f"DeepFace.find took {end_time - start_time:.4f} seconds")
-    
-    if len(dfs) > 0:
-        print("DeepFace.find returned results.")
-        print(dfs[0].head())
-    else:
-        print("DeepFace.find returned no results.")
-
-except Exception as e:
-    import traceback
-    traceback.print_exc()
-    print(f"An error occurred: {e}", flush=True)
-
-print("Test Complete.", flush=True)
+            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                paths.append(os.path.join(root, file))
+    return sorted(paths)
+
+
+def main():
+    args = parse_args()
+    # The pipeline reads its config at import time, so apply overrides first
+    if args.detector:
+        os.environ["FACE_DETECTOR"] = args.detector
+    if args.model:
+        os.environ["FACE_MODEL"] = args.model
+    if args.embedder:
+        os.environ["FACE_EMBEDDER"] = args.embedder
+
+    import face_model
+    from embedding_index import EmbeddingIndex
+    from image_io import decode_frame
+
+    print(f"Pipeline: {face_model.MODEL_CONFIG}")
+    paths = find_images(args.images)
+    if not paths:
+        print(f"Error: No image found in {args.images} to test with.")
+        exit(1)
+    print(f"Fixtures: {len(paths)} photo(s) from {args.images}\n")
+
+    # Model load is a one-off cost but worth knowing for cold starts
+    start = time.perf_counter()
+    face_model.get_model()
+    print(f"{'model load':<34} {time.perf_counter() - start:8.2f} s\n")
+
+    # --- decode ---
+    encoded = [cv2.imencode(".jpg", cv2.imread(path))[1].tobytes() for path in paths]
+    frames = [decode_frame(buf) for buf in encoded]
+    i = iter(range(10 ** 9))
+    report("decode (reduced scale)", timed(lambda: decode_frame(encoded[next(i) % len(encoded)]), args.repeat))
+    report("decode (full scale)", timed(
+        lambda: cv2.imdecode(np.frombuffer(encoded[next(i) % len(encoded)], np.uint8), cv2.IMREAD_COLOR), args.repeat))
+
+    # --- detect + align ---
+    report("detect + align", timed(lambda: face_model.detect_faces(frames[next(i) % len(frames)]), args.repeat))
+    crops = [face_model.detect_faces(frame)[0][1] for frame in frames]
+
+    # --- embed ---
+    report("embed (batch 1)", timed(lambda: face_model.embed_faces([crops[next(i) % len(crops)]]), args.repeat))
+    batch = [crops[k % len(crops)] for k in range(args.batch)]
+    report(f"embed (batch {args.batch})", timed(lambda: face_model.embed_faces(batch), args.repeat), items=args.batch)
+    dim = face_model.embed_faces(crops[:1]).shape[1]
+    print()
+
+    # --- match: synthetic rosters of unit vectors with some per-identity spread ---
+    rng = np.random.default_rng(0)
+    for size in [int(s) for s in args.sizes.split(",")]:
+        identities = rng.normal(size=(size, dim)).astype(np.float32)
+        templates = {f"ID{k:05d}": identities[k] + 0.3 * rng.normal(size=(args.samples, dim)).astype(np.float32)
+                     for k in range(size)}
+        queries = identities[rng.integers(0, size, 64)] + 0.3 * rng.normal(size=(64, dim)).astype(np.float32)
+        modes = [("exact", None)] + ([("ann", 0)] if args.ann else [])
+        for mode, ann_threshold in modes:
+            index = EmbeddingIndex(threshold=face_model.default_threshold(), ann_threshold=ann_threshold)
+            start = time.perf_counter()
+            index.replace_many(templates)
+            build = time.perf_counter() - start
+            report(f"match {mode} @ {size} ids (build {build:.2f}s)",
+                   timed(lambda: index.search(queries[next(i) % len(queries)]), args.repeat))
+
+    # --- end to end on one frame (no tracking, single process) ---
+    print()
+    index = EmbeddingIndex(threshold=face_model.default_threshold())
+    index.replace_many({"fixture": face_model.embed_faces(crops)})
+
+    def end_to_end():
+        frame = decode_frame(encoded[next(i) % len(encoded)])
+        faces = face_model.detect_faces(frame)
+        index.search(face_model.embed_faces([face for _, face in faces]))
+
+    report("end to end (decode..match)", timed(end_to_end, args.repeat))
+    print("\nBenchmark Complete.", flush=True)
+
+
+if __name__ == "__main__":
+    main()